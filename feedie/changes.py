@@ -0,0 +1,168 @@
+from twisted.internet import reactor, defer, task
+from twisted.python import log
+
+from feedie.design_doc import slim_doc
+
+def rev_number(doc):
+  return int(doc.get('_rev', '0-').split('-')[0])
+
+# Follows the database's _changes feed and applies each change to the models
+# already in memory, so they stay current without querying views again. That
+# includes changes made by another Feedie or a sync peer.
+#
+# It starts from the update_seq read before Sources.load queries anything,
+# so nothing that happens during the load is missed. The sequence isn't kept
+# between runs, since the models it keeps current aren't either.
+#
+# Models only count as current while it's healthy: running, with its last
+# poll answered. Otherwise they're queried again. A change that can't be
+# applied is logged and skipped, and its feed is queried again too.
+class Mirror(object):
+  # Milliseconds CouchDB holds each long poll open. Stays under the http
+  # client's header timeout.
+  poll_timeout = 30000
+
+  # Seconds to wait after a failed poll.
+  retry_delay = 5
+
+  def __init__(self, sources, clock=reactor):
+    self.sources = sources
+    self.db = sources.db
+    self.clock = clock
+    self.since = None
+    self.running = False
+    self.applied = 0
+    self.skipped = 0
+    self.failures = 0
+    self.errors = 0
+    self.failing = False
+    self.stale = {} # feed id -> feed whose summary needs reloading
+    self.reloads = 0
+
+  @defer.inlineCallbacks
+  def current_seq(self):
+    info = yield self.db.get('')
+    defer.returnValue(info['update_seq'])
+
+  def start(self, since):
+    self.since = since
+    self.running = True
+    self.poll()
+
+  def stop(self):
+    self.running = False
+
+  @property
+  def healthy(self):
+    return self.running and not self.failing
+
+  def stats(self):
+    return dict(since=self.since, applied=self.applied, skipped=self.skipped,
+        failures=self.failures, errors=self.errors, reloads=self.reloads)
+
+  @defer.inlineCallbacks
+  def poll(self):
+    try:
+      while self.running:
+        try:
+          result = yield self.db.changes(self.since, self.poll_timeout,
+              include_docs='true')
+        except Exception:
+          self.failures += 1
+          self.failing = True
+          yield task.deferLater(self.clock, self.retry_delay, lambda: None)
+          continue
+
+        self.failing = False
+        for row in result['results']:
+          if 'doc' in row:
+            try:
+              self.apply(row['doc'])
+            except Exception:
+              self.apply_failed(row['doc'])
+        self.since = result['last_seq']
+        if self.stale:
+          self.reload_stale()
+    finally:
+      self.running = False
+
+  def apply_failed(self, doc):
+    log.err()
+    self.errors += 1
+    feed_id = doc.get('feed_id') if isinstance(doc, dict) else None
+    feed = self.sources.feeds.get(feed_id)
+    if feed is not None:
+      feed.posts_loaded = False
+      self.stale[feed.id] = feed
+
+  # One query for all the feeds this batch left unsure of. If it fails,
+  # Sources.reconcile_summaries catches them up later.
+  def reload_stale(self):
+    feeds, self.stale = self.stale.values(), {}
+    self.reloads += 1
+    d = self.sources.reload_summaries(feeds)
+    d.addErrback(lambda reason: None)
+
+  def apply(self, doc):
+    kind = doc.get('type')
+    if kind == 'post':
+      applied = self.apply_post(doc)
+    elif kind == 'feed':
+      applied = self.apply_feed(doc)
+    else:
+      applied = False
+
+    if applied:
+      self.applied += 1
+    else:
+      self.skipped += 1
+
+  def apply_feed(self, doc):
+    sources = self.sources
+    feed = sources.feeds.get(doc['_id'])
+    if feed is None:
+      if doc.get('_deleted'): return False
+      sources.upsert_feeds([doc])
+      return True
+
+    if rev_number(doc) <= rev_number(feed.doc): return False
+    if doc.get('_deleted'): return False
+    feed.doc = doc
+    return True
+
+  # Summaries follow each change as a delta from the post's state before it.
+  # A post not in memory has no such state unless this is its first
+  # revision, so its feed's summary is reloaded instead.
+  def apply_post(self, doc):
+    feed = self.sources.feeds.get(doc.get('feed_id'))
+    if feed is None: return False
+
+    post = feed.posts.get(doc['_id'])
+    if post is not None and rev_number(doc) <= rev_number(post):
+      return False
+
+    if doc.get('_deleted') or doc.get('deleted_at'):
+      if post is None:
+        if rev_number(doc) > 1:
+          self.stale[feed.id] = feed
+        return False
+      feed.remove_post(post)
+      return True
+
+    if post is None:
+      if rev_number(doc) == 1:
+        feed.upsert_posts([slim_doc(doc)])
+        return True
+      post, = feed.upsert_posts([slim_doc(doc)], update_summary=False)
+      if rev_number(doc) > rev_number(post):
+        post.update_doc(doc) # it was still alive somewhere else
+      self.stale[feed.id] = feed
+      return True
+
+    was_read, was_starred = post.read, post.starred
+    post.update_doc(doc)
+    if post.read != was_read:
+      self.sources.emit_posts_marked(post.read, [post])
+    if post.starred != was_starred:
+      post.emit('changed::starred', post.starred, post.read)
+    return True
@@ -1,9 +1,14 @@
-from itertools import repeat, imap
+from collections import deque
 import urlparse
 from oauth import oauth
 import cgi
-import httplib2
-from twisted.internet import defer
+import hmac
+import time
+import random
+import hashlib
+import binascii
+import base64
+from twisted.internet import reactor, defer, task
 import urllib
 try:
   import simplejson as json
@@ -11,8 +16,6 @@ except ImportError:
   import json
 import couchdb
 
-from feedie import util
-
 debug = False
 
 JSON_PARAMS = 'key startkey endkey'.split()
@@ -35,8 +38,201 @@ def classify_error(doc):
     return couchdb.client.ResourceNotFound(doc)
   return ResponseError(doc)
 
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+class OAuthSigner(object):
+  '''
+    Produces the same HMAC-SHA1 Authorization header as the oauth library,
+    but builds everything that doesn't change between requests only once.
+  '''
+
+  def __init__(self, oauth_tokens):
+    escape = oauth.escape
+    self.consumer_key = oauth_tokens['consumer_key']
+    self.token = oauth_tokens['token']
+    key = '%s&%s' % (escape(oauth_tokens['consumer_secret']),
+        escape(oauth_tokens['token_secret']))
+    self.hmac = hmac.new(key, digestmod=hashlib.sha1)
+    self.fixed = [
+      ('oauth_consumer_key', escape(self.consumer_key)),
+      ('oauth_signature_method', 'HMAC-SHA1'),
+      ('oauth_token', escape(self.token)),
+      ('oauth_version', oauth.OAuthRequest.version),
+    ]
+    # Without a query string, the signed parameters are always these, in
+    # this order.
+    self.plain_params = ('oauth_consumer_key=%s&oauth_nonce=%%s&'
+        'oauth_signature_method=HMAC-SHA1&oauth_timestamp=%%s&'
+        'oauth_token=%s&oauth_version=%s') % (self.fixed[0][1],
+        self.fixed[2][1], self.fixed[3][1])
+    self.header = ('OAuth realm="", oauth_consumer_key="%s", '
+        'oauth_signature_method="HMAC-SHA1", oauth_token="%s", '
+        'oauth_version="%s", oauth_timestamp="%%s", oauth_nonce="%%s", '
+        'oauth_signature="%%s"') % (self.fixed[0][1], self.fixed[2][1],
+        self.fixed[3][1])
+    self.url_prefixes = {}
+
+  def sign(self, verb, full_http_url):
+    timestamp = str(int(time.time()))
+    nonce = '%08d' % random.randrange(100000000)
+    return self.headers(verb, full_http_url, timestamp, nonce)
+
+  def headers(self, verb, full_http_url, timestamp, nonce):
+    escape = oauth.escape
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(full_http_url)
+    if query:
+      key_values = [(escape(k), escape(v))
+          for k, v in dict(cgi.parse_qsl(query)).items()]
+      key_values.extend(self.fixed)
+      key_values.append(('oauth_nonce', nonce))
+      key_values.append(('oauth_timestamp', timestamp))
+      key_values.sort()
+      params = '&'.join(['%s=%s' % kv for kv in key_values])
+    else:
+      params = self.plain_params % (nonce, timestamp)
+
+    prefix = self.url_prefixes.get((scheme, netloc))
+    if prefix is None:
+      host = netloc
+      if scheme == 'http' and host.endswith(':80'):
+        host = host[:-3]
+      prefix = escape('%s://%s' % (scheme, host))
+      self.url_prefixes[scheme, netloc] = prefix
+
+    raw = '%s&%s%s&%s' % (escape(verb.upper()), prefix, escape(path),
+        escape(params))
+    hashed = self.hmac.copy()
+    hashed.update(raw)
+    signature = binascii.b2a_base64(hashed.digest())[:-1]
+    return {'authorization': self.header % (timestamp, nonce,
+        escape(signature))}
+
+class SessionAuth(object):
+  '''
+    Logs in to CouchDB once and sends its AuthSession cookie with every
+    request, which is much cheaper than signing each one. Logs in again if
+    the cookie stops working.
+  '''
+
+  def __init__(self, couch, name, password):
+    self.couch = couch
+    self.name = name
+    self.password = password
+    self.cookie = None
+    self.logging_in = None
+    self.logins = 0
+
+  def headers(self):
+    if self.cookie:
+      return defer.succeed({'cookie': self.cookie})
+    return self.login()
+
+  def expire(self):
+    self.cookie = None
+
+  def login(self):
+    promise = defer.Deferred()
+    if self.logging_in is not None:
+      self.logging_in.append(promise)
+      return promise
+    self.logging_in = [promise]
+    self.logins += 1
+
+    couch = self.couch
+    url = 'http://%s:%d/_session' % (couch.host, couch.port)
+    body = urllib.urlencode(dict(name=self.name, password=self.password))
+    d = couch.http_client.request(url, 'POST', body=body, headers={
+      'content-type': 'application/x-www-form-urlencoded',
+      'accept': 'application/json',
+    })
+
+    @d.addCallback
+    def d(response):
+      cookie = response.headers.get('set-cookie', '').split(';')[0]
+      if response.status.code != 200 or not cookie:
+        raise ResponseError(json.loads(response.body or '{}'))
+      self.cookie = cookie
+      return {'cookie': cookie}
+
+    @d.addBoth
+    def d(x):
+      waiters, self.logging_in = self.logging_in, None
+      for waiter in waiters:
+        if isinstance(x, dict):
+          waiter.callback(x)
+        else:
+          waiter.errback(x)
+
+    return promise
+
+# Pulls rows out of a view response as it arrives.
+#
+# CouchDB writes each row on its own line, so we only try to decode a row
+# once a newline has arrived after its start. If a response isn't laid out
+# like that, rows still come out, just not until the end.
+class RowParser(object):
+  decoder = json.JSONDecoder()
+
+  def __init__(self, on_rows, batch_size):
+    self.on_rows = on_rows
+    self.batch_size = batch_size
+    self.buffer = ''
+    self.in_rows = False
+    self.done = False
+    self.batch = []
+    self.count = 0
+
+  def write(self, data):
+    self.buffer += data
+    self._parse(False)
+
+  def close(self):
+    self._parse(True)
+    if not self.done:
+      raise ResponseError({'error': 'bad_response',
+          'reason': 'view response ended before its rows did'})
+    self._flush()
+
+  def _parse(self, final):
+    buffer = self.buffer
+    if not self.in_rows:
+      start = buffer.find('"rows"')
+      if start < 0: return
+      start = buffer.find('[', start)
+      if start < 0: return
+      self.in_rows = True
+      buffer = buffer[start + 1:]
+
+    pos = 0
+    while not self.done:
+      while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+        pos += 1
+      if pos == len(buffer): break
+      if buffer[pos] == ']':
+        self.done = True
+        break
+      if not final and buffer.find('\n', pos) < 0: break
+      try:
+        row, pos = self.decoder.raw_decode(buffer, pos)
+      except ValueError:
+        if final: raise
+        break
+      self.batch.append(row)
+      self.count += 1
+      if len(self.batch) >= self.batch_size:
+        self._flush()
+
+    self.buffer = '' if self.done else buffer[pos:]
+
+  def _flush(self):
+    if self.batch:
+      batch, self.batch = self.batch, []
+      self.on_rows(batch)
+
 class AsyncCouch:
-  def __init__(self, couchdb, http_client, oauth_tokens):
+  # If credentials (a name and password) are given and the database is on
+  # this machine, requests use cookie auth instead of signing each one.
+  def __init__(self, couchdb, http_client, oauth_tokens, credentials=None):
     self.couchdb = couchdb
     self.http_client = http_client
     uri = urlparse.urlsplit(couchdb.resource.uri, 'http')
@@ -44,22 +240,52 @@ class AsyncCouch:
     self.port = uri.port
     self.base_path = uri.path + '/'
     self.oauth_tokens = oauth_tokens
-
-  def request(self, verb, path, headers, body=None):
-    def success(response):
-      promise.callback(response)
-
-    promise = defer.Deferred()
-
+    # 'design/view' -> another design doc to query it from instead. See
+    # design_doc.Migrator.
+    self.view_routes = {}
+    self.signer = OAuthSigner(oauth_tokens)
+    self.bulk_docs = 0
+    self.bulk_bytes = 0
+    self.bulk_batches = 0
+    self.bulk_conflicts = 0
+    self.bulk_seconds = 0.0 # while any batch was in flight
+    self.bulk_active = 0
+    self.bulk_since = None
+    self.conflict_retries = 0
+    self.conflicts_given_up = 0
+    self.session = None
+    if credentials and self.host in LOCAL_HOSTS:
+      self.session = SessionAuth(self, *credentials)
+
+  def request(self, verb, path, headers, body=None, consumer=None,
+      pipeline=True):
     full_http_url = "http://%s:%d%s" % (self.host, self.port, path)
-    headers.update(self.make_oauth_headers(verb, full_http_url))
-    d = self.http_client.request(full_http_url, verb,
-        headers=headers, body=body)
-    d.addCallback(success)
-    d.addErrback(promise.errback)
-    return promise
-
-  def interact(self, verb, path, success_status, params, body=None):
+    if self.session is None:
+      headers.update(self.make_oauth_headers(verb, full_http_url))
+      return self.http_client.request(full_http_url, verb,
+          headers=headers, body=body, consumer=consumer, pipeline=pipeline)
+
+    def send(auth_headers):
+      headers.update(auth_headers)
+      return self.http_client.request(full_http_url, verb,
+          headers=headers, body=body, consumer=consumer, pipeline=pipeline)
+
+    def check(response, retry):
+      if response.status.code == 401 and retry:
+        self.session.expire()
+        return attempt(False)
+      return response
+
+    def attempt(retry):
+      d = self.session.headers()
+      d.addCallback(send)
+      d.addCallback(check, retry)
+      return d
+
+    return attempt(True)
+
+  def interact(self, verb, path, success_status, params, body=None,
+      pipeline=True):
     def success(response):
       if debug: print 'COMPLETE', verb, request_path
       value = json.loads(response.body)
@@ -78,10 +304,12 @@ class AsyncCouch:
     headers['Accept'] = 'application/json'
 
     if body:
-      body_str = json.dumps(body)
-      request = self.request(verb, request_path, headers, body=body_str)
+      # Bodies that are already JSON are sent as they are.
+      body_str = body if isinstance(body, str) else json.dumps(body)
+      request = self.request(verb, request_path, headers, body=body_str,
+          pipeline=pipeline)
     else:
-      request = self.request(verb, request_path, headers)
+      request = self.request(verb, request_path, headers, pipeline=pipeline)
 
     request.addCallback(success)
     request.addErrback(promise.errback)
@@ -97,24 +325,88 @@ class AsyncCouch:
   def put(self, path, success_status=201, body=None, **params):
     return self.interact('PUT', path, success_status, params, body=body)
 
-  @defer.inlineCallbacks
-  def view(self, name, **params):
+  def delete(self, path, success_status=200, **params):
+    return self.interact('DELETE', path, success_status, params)
+
+  def view_path(self, name):
     if '/' in name:
       design_doc_name, view_name = name.split('/')
-      path = '_design/%s/_view/%s' % (urllib.quote_plus(design_doc_name),
+      design_doc_name = self.view_routes.get(name, design_doc_name)
+      return '_design/%s/_view/%s' % (urllib.quote_plus(design_doc_name),
                                       urllib.quote_plus(view_name))
-    else:
-      path = name
+    return name
+
+  # A view query may wait for its index to catch up, so nothing gets
+  # pipelined behind it unless it's allowed to be stale. Built-in views like
+  # _all_docs have no index to wait for.
+  def view_pipelines(self, name, params):
+    return '/' not in name or 'stale' in params
+
+  @defer.inlineCallbacks
+  def view(self, name, **params):
+    path = self.view_path(name)
+    pipeline = self.view_pipelines(name, params)
     if 'keys' in params:
       keys = params.pop('keys')
       body = {'keys': keys}
-      response = yield self.post(path, success_status=200, body=body, **params)
+      response = yield self.interact('POST', path, 200, params, body=body,
+          pipeline=pipeline)
     else:
-      response = yield self.get(path, **params)
+      response = yield self.interact('GET', path, 200, params,
+          pipeline=pipeline)
     defer.returnValue(response['rows'])
 
+  # Like view, but rows are decoded as the response arrives and passed to
+  # on_rows in lists of up to batch_size, so the whole response is never held
+  # at once. Returns a deferred that fires with the number of rows once
+  # on_rows has seen them all.
+  def view_iter(self, name, on_rows, batch_size=500, **params):
+    def consumer(status, headers):
+      if status.code == 200:
+        return parser
+
+    def success(response):
+      if debug: print 'COMPLETE', verb, request_path
+      if response.body is not None:
+        raise classify_error(json.loads(response.body))
+      parser.close()
+      return parser.count
+
+    parser = RowParser(on_rows, batch_size)
+    path = self.view_path(name)
+    params = params.copy()
+    body = None
+    verb = 'GET'
+    if 'keys' in params:
+      verb = 'POST'
+      body = json.dumps({'keys': params.pop('keys')})
+    request_path = self.base_path + path + encode_params(params)
+    if debug: print 'COUCH', verb, request_path
+
+    pipeline = self.view_pipelines(name, params)
+    d = self.request(verb, request_path, {'Accept': 'application/json'},
+        body=body, consumer=consumer, pipeline=pipeline)
+    d.addCallback(success)
+    return d
+
+  # Long-polls _changes, waiting up to timeout milliseconds for something
+  # after since. Nothing gets pipelined behind it, since it's slow to answer
+  # on purpose.
+  @defer.inlineCallbacks
+  def changes(self, since, timeout, **params):
+    params = dict(params, feed='longpoll', since=since, timeout=timeout)
+    request_path = self.base_path + '_changes' + encode_params(params)
+    if debug: print 'COUCH', 'GET', request_path
+    response = yield self.request('GET', request_path,
+        {'Accept': 'application/json'}, pipeline=False)
+    value = json.loads(response.body)
+    if response.status.code != 200:
+      raise classify_error(value)
+    defer.returnValue(value)
+
+  # Returns a deferred that fires once the view's index is up to date.
   def touch_view(self, name):
-    self.view(name, startkey={}, endkey={})
+    return self.view(name, startkey={}, endkey={})
 
   def load_doc(self, doc_id):
     return self.get(urllib.quote_plus(doc_id))
@@ -164,63 +456,194 @@ class AsyncCouch:
     request_path = self.base_path + path + encode_params(dict(rev=rev))
     yield self.request('DELETE', request_path, {})
 
-  # returns a list of documents (maybe with fewer than doc_ids)
+  # Returns {doc_id: data} for each of doc_ids that has the named attachment,
+  # fetched along with the docs in one request. Servers that only send stubs
+  # there get one request per attachment instead.
+  @defer.inlineCallbacks
+  def get_attachments(self, doc_ids, name):
+    rows = yield self.view('_all_docs', include_docs='true',
+        attachments='true', keys=doc_ids)
+    result = {}
+    stubs = []
+    for row in rows:
+      doc = row.get('doc')
+      if not doc: continue
+      att = doc.get('_attachments', {}).get(name)
+      if att is None: continue
+      if 'data' in att:
+        result[doc['_id']] = base64.b64decode(att['data'])
+      else:
+        stubs.append(doc['_id'])
+
+    ds = [self.get_attachment(doc_id, name) for doc_id in stubs]
+    fetched = yield defer.DeferredList(ds, consumeErrors=True)
+    for doc_id, (success, data) in zip(stubs, fetched):
+      if success:
+        result[doc_id] = data
+    defer.returnValue(result)
+
+  # returns a list of documents (maybe with fewer than doc_ids, since ids
+  # that were never saved or have been deleted are left out)
   @defer.inlineCallbacks
   def load_docs(self, doc_ids):
     rows = yield self.view('_all_docs', include_docs='true', keys=doc_ids)
-    defer.returnValue([row['doc'] for row in rows])
+    defer.returnValue([row['doc'] for row in rows if row.get('doc')])
 
+  # Bulk writes go out in batches of at most BATCH_SIZE docs and about
+  # BATCH_BYTES of JSON, with up to BULK_CONCURRENCY batches in flight.
   BATCH_SIZE = 1000
+  BATCH_BYTES = 1024 * 1024
   BULK_CONCURRENCY = 2
 
   # returns a list of responses as documented in
   # http://wiki.apache.org/couchdb/HTTP_Bulk_Document_API
   def save_docs(self, docs, split='auto'):
-    if split == 'auto':
-      split = len(docs) > self.BATCH_SIZE
+    def start_batches():
+      while pending and in_flight[0] < self.BULK_CONCURRENCY:
+        i, (start, end) = pending.popleft()
+        body = '{"docs":[%s]}' % ','.join(encoded[start:end])
+        in_flight[0] += 1
+        self.bulk_busy(1)
+        d = self.post('_bulk_docs', body=body)
+        d.addCallbacks(batch_saved, batch_failed,
+            callbackArgs=(i, end - start, len(body)))
+
+    def batch_saved(rows, i, count, size):
+      in_flight[0] -= 1
+      self.bulk_busy(-1)
+      if promise.called: return
+      results[i] = rows
+      self.bulk_docs += count
+      self.bulk_bytes += size
+      self.bulk_batches += 1
+      for row in rows:
+        if row.get('error') == 'conflict':
+          self.bulk_conflicts += 1
+      if pending:
+        start_batches()
+      elif not in_flight[0]:
+        promise.callback([row for batch in results for row in batch])
+
+    def batch_failed(reason):
+      in_flight[0] -= 1
+      self.bulk_busy(-1)
+      pending.clear()
+      if not promise.called:
+        promise.errback(reason)
 
-    if not split:
-      return self.post('_bulk_docs', body=dict(docs=docs))
-
-    # split into multiple sets and send them in parallel
     promise = defer.Deferred()
-    groups = util.n_groups(self.BULK_CONCURRENCY, docs)
-    ds = tuple(imap(self.save_docs, groups, repeat(False)))
-    dl = defer.DeferredList(ds, fireOnOneErrback=True)
-
-    @dl.addCallback
-    def dl(result):
-      rows = []
-      for success, value in result:
-        if not success: return promise.errback(value)
-        rows.extend(value)
-      promise.callback(rows)
-
-    dl.addErrback(promise.errback)
+    encoded = [json.dumps(doc) for doc in docs]
+    if split:
+      batches = self.split_batches(encoded)
+    else:
+      batches = [(0, len(encoded))]
+    pending = deque(enumerate(batches))
+    results = [[]] * len(batches)
+    in_flight = [0]
+
+    if not batches:
+      promise.callback([])
+    else:
+      start_batches()
     return promise
 
+  # Returns (start, end) slices of encoded docs, each slice being one batch.
+  def split_batches(self, encoded):
+    batches = []
+    start, size = 0, 0
+    for i, doc in enumerate(encoded):
+      count = i - start
+      if count and (count >= self.BATCH_SIZE or
+          size + len(doc) > self.BATCH_BYTES):
+        batches.append((start, i))
+        start, size = i, 0
+      size += len(doc) + 1
+    if start < len(encoded):
+      batches.append((start, len(encoded)))
+    return batches
+
+  # bulk_seconds counts the time any batch is in flight, so calls that
+  # overlap aren't counted twice.
+  def bulk_busy(self, change):
+    if not self.bulk_active:
+      self.bulk_since = time.time()
+    self.bulk_active += change
+    if not self.bulk_active:
+      self.bulk_seconds += time.time() - self.bulk_since
+
+  def bulk_stats(self):
+    seconds = self.bulk_seconds or 1
+    return dict(docs=self.bulk_docs, bytes=self.bulk_bytes,
+        batches=self.bulk_batches, conflicts=self.bulk_conflicts,
+        docs_per_second=self.bulk_docs / seconds,
+        bytes_per_second=self.bulk_bytes / seconds)
+
+  # Conflicting writes are tried again at most MAX_ATTEMPTS times in all,
+  # each retry waiting RETRY_DELAY seconds, doubled every time and jittered
+  # by up to RETRY_JITTER either way so racing writers fall out of step.
+  MAX_ATTEMPTS = 5
+  RETRY_DELAY = 0.05
+  RETRY_JITTER = 0.5
+
+  def retry_pause(self, attempt):
+    delay = self.RETRY_DELAY * 2 ** (attempt - 1)
+    delay *= 1 + random.uniform(-self.RETRY_JITTER, self.RETRY_JITTER)
+    return task.deferLater(reactor, delay, lambda: None)
+
+  # Like load_docs, but ids with no doc (never saved, or deleted since) get
+  # a bare {'_id': id}, same as a doc that isn't loaded first.
   @defer.inlineCallbacks
-  def modify_doc(self, doc_id, f, load_first=False, doc=None):
-    while True:
-      if doc is None:
-        if load_first:
-          doc = yield self.load_doc(doc_id)
-        else:
-          doc = {'_id': doc_id}
+  def load_current(self, doc_ids):
+    rows = yield self.view('_all_docs', include_docs='true', keys=doc_ids)
+    defer.returnValue([row.get('doc') or {'_id': row['key']} for row in rows])
 
-      f(doc)
+  def retry_stats(self):
+    return dict(retries=self.conflict_retries, given_up=self.conflicts_given_up)
+
+  # On a conflict, the doc is loaded again and, if merge is given, saved as
+  # merge(current, attempted), else f is applied to it again. After
+  # MAX_ATTEMPTS conflicts the ResourceConflict is raised.
+  @defer.inlineCallbacks
+  def modify_doc(self, doc_id, f, load_first=False, doc=None, merge=None):
+    if doc is None:
+      if load_first:
+        doc = yield self.load_doc(doc_id)
+      else:
+        doc = {'_id': doc_id}
+    f(doc)
 
+    attempt = 1
+    while True:
       try:
         doc = yield self.save_doc(doc)
         defer.returnValue(doc)
       except couchdb.client.ResourceConflict:
-        load_first, doc = True, None
+        if attempt >= self.MAX_ATTEMPTS:
+          self.conflicts_given_up += 1
+          raise
+      self.conflict_retries += 1
+      yield self.retry_pause(attempt)
+      attempt += 1
+
+      current, = yield self.load_current([doc_id])
+      if merge:
+        doc = merge(current, doc)
+      else:
+        doc = current
+        f(doc)
 
   # f may signal that it doesn't want to modify a doc by removing all entries
-  # from the document.
+  # from the document. So may merge, by returning nothing.
+  #
+  # Conflicts are retried as in modify_doc, all of a round's together. Ids
+  # still conflicting after MAX_ATTEMPTS are left out of the result and, if
+  # given_up is a list, added to it. Any other error saving a doc is raised,
+  # unless failed is a list: then the doc is left out and its id added there,
+  # and the rest are still saved.
   # TODO: return a list of promises, not just one
   @defer.inlineCallbacks
-  def modify_docs(self, doc_ids, f, load_first=False, docs=None):
+  def modify_docs(self, doc_ids, f, load_first=False, docs=None, merge=None,
+      given_up=None, failed=None):
     if docs is None:
       if load_first:
         docs = yield self.load_docs(doc_ids)
@@ -230,37 +653,67 @@ class AsyncCouch:
     for doc in docs:
       f(doc)
 
-    docs = filter(None, docs) # leave out ones they don't want to modify
-
-    rev = dict([(doc['_id'], doc) for doc in docs])
-
-    rows = yield self.save_docs(docs)
-    conflict_ids = []
     successes = {}
-    for row in rows:
-      if 'error' in row:
-        if row['error'] == 'conflict':
-          conflict_ids.append(row['id'])
+    attempt = 1
+    while True:
+      docs = filter(None, docs) # leave out ones they don't want to modify
+      rev = dict([(doc['_id'], doc) for doc in docs])
+
+      rows = yield self.save_docs(docs)
+      conflict_ids = []
+      for row in rows:
+        if 'error' in row:
+          if row['error'] == 'conflict':
+            conflict_ids.append(row['id'])
+          elif failed is not None:
+            failed.append(row['id'])
+          else:
+            raise classify_error(row)
         else:
-          raise classify_error(row)
+          doc = rev[row['id']]
+          doc['_id'] = row['id']
+          doc['_rev'] = row['rev']
+          successes[row['id']] = doc
+
+      if not conflict_ids: break
+      if attempt >= self.MAX_ATTEMPTS:
+        self.conflicts_given_up += len(conflict_ids)
+        if given_up is not None:
+          given_up.extend(conflict_ids)
+        break
+
+      self.conflict_retries += len(conflict_ids)
+      yield self.retry_pause(attempt)
+      attempt += 1
+
+      docs = yield self.load_current(conflict_ids)
+      if merge:
+        docs = [merge(d, rev[d['_id']]) for d in docs]
       else:
-        doc = rev[row['id']]
-        doc['_id'] = row['id']
-        doc['_rev'] = row['rev']
-        successes[row['id']] = doc
-
-    if conflict_ids:
-      inner_docs = yield self.modify_docs(conflict_ids, f, True)
-      for inner_doc in inner_docs:
-        successes[inner_doc['_id']] = inner_doc
+        for doc in docs:
+          f(doc)
 
     defer.returnValue([successes[id] for id in doc_ids if id in successes])
 
   def make_oauth_headers(self, verb, full_http_url):
-    consumer = oauth.OAuthConsumer(self.oauth_tokens['consumer_key'],
-        self.oauth_tokens['consumer_secret'])
-    access_token = oauth.OAuthToken(self.oauth_tokens['token'],
-        self.oauth_tokens['token_secret'])
+    return self.signer.sign(verb, full_http_url)
+
+if __name__ == '__main__':
+  # Micro-benchmark: per-request signing cost, the way make_oauth_headers
+  # used to do it versus OAuthSigner, and a check that both sign alike.
+  import httplib2
+  tokens = dict(consumer_key='ck', consumer_secret='cs s', token='tk',
+      token_secret='ts&')
+  urls = [
+    'http://localhost:5984/feedie/_bulk_docs',
+    'http://localhost:5984/feedie/_design/feedie/_view/feeds?'
+        'startkey=%5B%22a%22%5D&include_docs=true',
+  ]
+
+  def old_headers(verb, full_http_url):
+    consumer = oauth.OAuthConsumer(tokens['consumer_key'],
+        tokens['consumer_secret'])
+    access_token = oauth.OAuthToken(tokens['token'], tokens['token_secret'])
     sig_method = oauth.OAuthSignatureMethod_HMAC_SHA1
     query = urlparse.urlsplit(full_http_url).query
     querystr_as_dict = dict(cgi.parse_qsl(query))
@@ -270,3 +723,22 @@ class AsyncCouch:
         parameters = querystr_as_dict)
     req.sign_request(sig_method(), consumer, access_token)
     return httplib2._normalize_headers(req.to_header())
+
+  signer = OAuthSigner(tokens)
+  parse = lambda h: dict([x.split('=', 1) for x in h.split(', ')])
+  for url in urls:
+    expected = parse(old_headers('GET', url)['authorization'])
+    got = parse(signer.headers('GET', url,
+        expected['oauth_timestamp'].strip('"'),
+        expected['oauth_nonce'].strip('"'))['authorization'])
+    assert expected == got, (expected, got)
+
+  n = 20000
+  for url in urls:
+    for name, sign in (('oauth', old_headers), ('signer', signer.sign)):
+      start = time.time()
+      for i in xrange(n):
+        sign('GET', url)
+      elapsed = time.time() - start
+      print '%-6s %-5s %.1fus per request' % (name,
+          'query' if '?' in url else 'plain', elapsed / n * 1e6)
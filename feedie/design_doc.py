@@ -1,46 +1,37 @@
+import hashlib
+try:
+  import simplejson as json
+except ImportError:
+  import json
 import couchdb
+from twisted.internet import reactor, defer, task
 
 DOC_ID = '_design/feedie'
 
-SUMMARY_MAP = '''
-function (doc) {
-  if (doc.type == 'post' && !doc.deleted_at) {
-    var summary = {total:1,read:0,starred_total:0,starred_read:0};
-    try {
+# Each post emits its counts in SUMMARY_KEYS order and CouchDB's builtin
+# _sum adds them up, with no JS run at reduce time.
+SUMMARY_KEYS = tuple('''
 
-      if (doc.read_updated_at >= doc.updated_at) {
-        summary.read = 1;
-      }
+  total read starred_total starred_read
 
-      if (!doc.deleted_at && doc.starred) {
-        summary.starred_total = 1;
-        if (doc.read_updated_at >= doc.updated_at) {
-          summary.starred_read = 1;
-        }
-      }
+'''.split())
 
-      emit(doc.feed_id, summary);
-    } catch (e) {
-      emit(doc.feed_id, summary);
-    }
+SUMMARY_MAP = '''
+function (doc) {
+  if (doc.type == 'post' && !doc.deleted_at) {
+    var read = doc.read_updated_at >= doc.updated_at ? 1 : 0;
+    var starred = doc.starred ? 1 : 0;
+    emit(doc.feed_id, [1, read, starred, starred & read]);
   }
 }
 '''
 
-SUMMARY_REDUCE = '''
-function (keys, values, rereduce) {
-  total = sum(values.map(function (x) { return x.total }));
-  read = sum(values.map(function (x) { return x.read }));
-  starred_total = sum(values.map(function (x) { return x.starred_total }));
-  starred_read = sum(values.map(function (x) { return x.starred_read }));
-  return {
-    total:total,
-    read:read,
-    starred_total:starred_total,
-    starred_read:starred_read,
-  };
-}
-'''
+# Turns a summary view value into a dict. Until a migration finishes, the
+# view may still be the old one, which reduced to a dict itself.
+def summary_dict(value):
+  if isinstance(value, dict):
+    return value
+  return dict(zip(SUMMARY_KEYS, value))
 
 FEED_MAP = '''
 function (doc) {
@@ -50,10 +41,34 @@ function (doc) {
 }
 '''
 
+# Post lists only emit what it takes to draw a row. The rest of the doc is
+# loaded when the post is opened. Keep POST_ROW and SLIM_POST_KEYS in step.
+SLIM_POST_KEYS = tuple('''
+
+  _id _rev feed_id title updated_at read_updated_at starred
+
+'''.split())
+
+def slim_doc(doc):
+  slim = dict([(k, doc[k]) for k in SLIM_POST_KEYS if k in doc])
+  slim['slim'] = True
+  return slim
+
+POST_ROW = '''{
+  _id: doc._id,
+  _rev: doc._rev,
+  feed_id: doc.feed_id,
+  title: doc.title,
+  updated_at: doc.updated_at,
+  read_updated_at: doc.read_updated_at,
+  starred: doc.starred,
+  slim: true,
+}'''
+
 FEED_POST_MAP = '''
 function (doc) {
   if (doc.type == 'post' && !doc.deleted_at) {
-    emit(doc.feed_id, doc);
+    emit(doc.feed_id, %(POST_ROW)s);
   }
 }
 ''' % locals()
@@ -63,10 +78,10 @@ function (doc) {
   if (doc.type == 'post' && !doc.deleted_at) {
     try {
       if (!(doc.read_updated_at >= doc.updated_at)) {
-        emit(doc.feed_id, doc);
+        emit(doc.feed_id, %(POST_ROW)s);
       }
     } catch (e) {
-      emit(doc.feed_id, doc);
+      emit(doc.feed_id, %(POST_ROW)s);
     }
   }
 }
@@ -77,10 +92,10 @@ function (doc) {
   if (doc.type == 'post' && !doc.deleted_at) {
     try {
       if (doc.starred) {
-        emit(doc.feed_id, doc);
+        emit(doc.feed_id, %(POST_ROW)s);
       }
     } catch (e) {
-      emit(doc.feed_id, doc);
+      emit(doc.feed_id, %(POST_ROW)s);
     }
   }
 }
@@ -139,42 +154,137 @@ def view(map, reduce=None):
   if reduce: d['reduce'] = reduce
   return d
 
-def add_views(db):
-  modified = False
-  try:
-    ddoc = db.couchdb[DOC_ID]
-  except couchdb.client.ResourceNotFound:
-    ddoc = {'_id': DOC_ID}
-    modified = True
-  if 'views' not in ddoc:
-    ddoc['views'] = {}
-  views = ddoc['views']
-  if 'summary' not in views:
-    views['summary'] = view(SUMMARY_MAP, SUMMARY_REDUCE)
-    modified = True
-  if 'feed' not in views:
-    views['feed'] = view(FEED_MAP)
-    modified = True
-  if 'feed_post' not in views:
-    views['feed_post'] = view(FEED_POST_MAP)
-    modified = True
-  if 'unread_posts' not in views:
-    views['unread_posts'] = view(UNREAD_POSTS_MAP)
-    modified = True
-  if 'starred_posts' not in views:
-    views['starred_posts'] = view(STARRED_POSTS_MAP)
-    modified = True
-  if 'posts_to_gc' not in views:
-    views['posts_to_gc'] = view(POSTS_TO_GC)
-    modified = True
-  if 'deleted_feeds' not in views:
-    views['deleted_feeds'] = view(DELETED_FEEDS)
-    modified = True
-  if 'redirected_feeds' not in views:
-    views['redirected_feeds'] = view(REDIRECTED_FEEDS)
-    modified = True
-  if 'posts_to_mark_feed_is_deleted' not in views:
-    views['posts_to_mark_feed_is_deleted'] = view(POSTS_TO_MARK_FEED_IS_DELETED)
-    modified = True
-  if modified:
-    db.couchdb[DOC_ID] = ddoc
+VIEWS = {
+  'summary': view(SUMMARY_MAP, '_sum'),
+  'feed': view(FEED_MAP),
+  'feed_post_slim': view(FEED_POST_MAP),
+  'unread_posts_slim': view(UNREAD_POSTS_MAP),
+  'starred_posts_slim': view(STARRED_POSTS_MAP),
+  'posts_to_gc': view(POSTS_TO_GC),
+  'deleted_feeds': view(DELETED_FEEDS),
+  'redirected_feeds': view(REDIRECTED_FEEDS),
+  'posts_to_mark_feed_is_deleted': view(POSTS_TO_MARK_FEED_IS_DELETED),
+}
+
+def view_hash(view):
+  return hashlib.sha1(json.dumps(view, sort_keys=True)).hexdigest()[:16]
+
+def set_hash(hashes):
+  return hashlib.sha1(json.dumps(hashes, sort_keys=True)).hexdigest()[:12]
+
+# Keeps the design doc in step with VIEWS without ever making startup wait
+# for an index to build.
+#
+# The design doc records a hash of each of its views. If they don't match
+# VIEWS, the new set is saved under a staging name made from the hashes, and
+# views that the live doc doesn't have yet are routed there so they work
+# right away. Views the live doc does have keep using its old version while
+# we nudge the staging index along in the background. Once it has caught up,
+# the same views are saved into the live doc. CouchDB keys index files by
+# the views they hold, so the live doc picks up the finished index instead
+# of building its own, and the staging doc is deleted. Progress is watched
+# through the staging doc's _info, which answers right away.
+class Migrator(object):
+  poll_interval = 2
+
+  def __init__(self, db, name=DOC_ID.split('/')[1], views=VIEWS, clock=reactor):
+    self.db = db
+    self.name = name
+    self.views = views
+    self.clock = clock
+    self.hashes = dict([(k, view_hash(v)) for k, v in views.items()])
+    self.staging_name = '%s-%s' % (name, set_hash(self.hashes))
+    self.state = 'new'
+    self.error = None
+    self.finished = defer.Deferred()
+
+  # Fires once every view in VIEWS can be queried, which never waits for an
+  # index to build. self.finished fires when the migration is done.
+  @defer.inlineCallbacks
+  def start(self):
+    self.state = 'checking'
+    try:
+      live = yield self.db.get('_design/' + self.name)
+    except couchdb.client.ResourceNotFound:
+      live = {'_id': '_design/' + self.name}
+
+    if live.get('hashes') == self.hashes:
+      self.done('current')
+      return
+
+    if not live.get('views'):
+      # Nothing to serve in the meantime, so just install them.
+      yield self.save_live(live)
+      self.done('installed')
+      return
+
+    staging = {
+      '_id': '_design/' + self.staging_name,
+      'language': 'javascript',
+      'views': self.views,
+      'hashes': self.hashes,
+    }
+    try:
+      yield self.db.put(staging['_id'], body=staging)
+    except couchdb.client.ResourceConflict:
+      pass # left over from an earlier run; same views, since same name
+
+    for name in self.views:
+      if name not in live['views']:
+        self.db.view_routes['%s/%s' % (self.name, name)] = self.staging_name
+
+    self.state = 'warming'
+    self.warm()
+
+  @defer.inlineCallbacks
+  def warm(self):
+    try:
+      info = yield self.db.get('')
+      target = info['update_seq']
+      touch = None
+      while True:
+        # A touch only answers once the index is built, so there's just the
+        # one in flight; another is sent only if it gave up early.
+        if touch is None or touch.called:
+          touch = self.db.touch_view('%s/%s' % (self.staging_name,
+              self.views.keys()[0]))
+          touch.addErrback(lambda reason: None)
+        info = yield self.db.get('_design/%s/_info' % self.staging_name)
+        index = info['view_index']
+        if index['update_seq'] >= target and not index['updater_running']:
+          break
+        yield task.deferLater(self.clock, self.poll_interval, lambda: None)
+
+      self.state = 'swapping'
+      while True:
+        try:
+          live = yield self.db.get('_design/' + self.name)
+        except couchdb.client.ResourceNotFound:
+          live = {'_id': '_design/' + self.name}
+        try:
+          yield self.save_live(live)
+          break
+        except couchdb.client.ResourceConflict:
+          pass
+
+      self.db.view_routes.clear()
+      staging = yield self.db.get('_design/' + self.staging_name)
+      yield self.db.delete('_design/' + self.staging_name, rev=staging['_rev'])
+      # Drop index files nothing uses any more. Needs admin, so best effort.
+      d = self.db.post('_view_cleanup', success_status=202)
+      d.addErrback(lambda reason: None)
+      self.done('migrated')
+    except Exception, ex:
+      # Staging routes stay in place, and the next start tries again.
+      self.error = ex
+      self.done('failed')
+
+  def save_live(self, live):
+    live['language'] = 'javascript'
+    live['views'] = self.views
+    live['hashes'] = self.hashes
+    return self.db.put(live['_id'], body=live)
+
+  def done(self, state):
+    self.state = state
+    self.finished.callback(state)
@@ -0,0 +1,117 @@
+import xml.parsers.expat
+from twisted.internet import defer
+
+ITEM_NAMES = ('item', 'entry')
+
+# Splits a feed into entries as its body arrives, so we can start saving posts
+# before the download finishes and never hold the whole document.
+#
+# We only use expat to find where each <item> or <entry> begins and ends. The
+# raw bytes of finished entries are glued back onto the feed's head (everything
+# before the first entry) and closing tags, and handed to parse in batches.
+# That way feedparser still does all the real work (sanitizing, dates, etc).
+#
+# If expat gives up before any entry is finished (not XML, unknown encoding,
+# an HTML page), we keep buffering and parse the whole body at the end, just
+# like before. If it gives up later, we keep the head plus whatever is left
+# and let feedparser's loose parser make sense of it at the end.
+class Parser(object):
+  batch_size = 50
+
+  def __init__(self, uri, parse, on_batch):
+    self.uri = uri
+    self.parse = parse
+    self.on_batch = on_batch
+    self.buffer = ''
+    self.base = 0 # absolute offset of self.buffer[0]
+    self.head = None
+    self.closing = None
+    self.pending = []
+    self.entries_done = 0
+    self.failed = False
+    self.saving = defer.succeed(None)
+
+    self.stack = []
+    self.item_depth = None
+    self.item_start = None
+    self.last_start = None
+
+    self.expat = xml.parsers.expat.ParserCreate()
+    # Treat undefined entities like &nbsp; as skipped instead of fatal.
+    self.expat.UseForeignDTD(True)
+    self.expat.StartElementHandler = self._start
+    self.expat.EndElementHandler = self._end
+
+  def write(self, data):
+    self.buffer += data
+    if self.failed: return
+    try:
+      self.expat.Parse(data, False)
+    except xml.parsers.expat.ExpatError:
+      self.failed = True
+
+  # Returns a deferred that fires with a feedparser result for the feed once
+  # every earlier batch has been handled. Its entries are the ones that
+  # haven't been passed to on_batch yet.
+  def close(self):
+    if not self.failed:
+      try:
+        self.expat.Parse('', True)
+      except xml.parsers.expat.ExpatError:
+        self.failed = True
+
+    if self.head is None or not self.entries_done:
+      body = self.buffer # never got going; parse the lot
+    else:
+      body = self.head + ''.join(self.pending) + self.buffer
+    self.pending = []
+    self.buffer = ''
+
+    d = self.saving
+    d.addCallback(lambda _: self.parse(body, self.uri))
+    return d
+
+  def _start(self, name, attrs):
+    index = self.expat.CurrentByteIndex
+    self.last_start = (name, index)
+    if self.item_start is None and name.split(':')[-1] in ITEM_NAMES:
+      if self.item_depth is None:
+        self.item_depth = len(self.stack)
+        self.head = self.buffer[:index - self.base]
+        self.closing = ''.join(['</%s>' % x.encode('utf-8')
+            for x in reversed(self.stack)])
+      if self.item_depth == len(self.stack):
+        self.item_start = index
+    self.stack.append(name)
+
+  def _end(self, name):
+    index = self.expat.CurrentByteIndex
+    self.stack.pop()
+    if self.item_start is None or len(self.stack) != self.item_depth: return
+
+    i = index - self.base
+    if self.last_start == (name, self.item_start) and \
+        self.buffer[i - 2:i] == '/>':
+      end = i # <item/>
+    else:
+      end = self.buffer.index('>', i) + 1
+
+    self.pending.append(self.buffer[self.item_start - self.base:end])
+    self.buffer = self.buffer[end:]
+    self.base += end
+    self.item_start = None
+    self.entries_done += 1
+
+    if len(self.pending) >= self.batch_size:
+      self._flush()
+
+  def _flush(self):
+    body = self.head + ''.join(self.pending) + self.closing
+    self.pending = []
+
+    def parse_and_handle(_):
+      d = self.parse(body, self.uri)
+      d.addCallback(self.on_batch)
+      return d
+
+    self.saving.addCallback(parse_and_handle)
@@ -1,15 +1,21 @@
 import re
+import zlib
 import urlparse
 import httplib2
-from collections import namedtuple
+from collections import namedtuple, deque
 from twisted.internet import protocol, reactor, error, defer
+from twisted.internet.error import ConnectionDone
 from twisted.web import http
 
 from feedie import util
+from feedie import resolver
 
 Status = namedtuple('Status', 'http_version code message')
-Response = namedtuple('Response', 'status headers body')
-Request = namedtuple('Request', 'method path headers body')
+Response = namedtuple('Response', 'status headers body stats')
+Stats = namedtuple('Stats', 'wire_bytes body_bytes')
+Request = namedtuple('Request',
+    'method path headers body consumer timeouts pipeline')
+Timeouts = namedtuple('Timeouts', 'headers body read')
 
 class InvalidStateError(Exception):
   pass
@@ -20,15 +26,130 @@ class UnsupportedSchemeError(Exception):
 class BadURIError(Exception):
   pass
 
+class DecodingError(Exception):
+  pass
+
+class ChunkedEncodingError(Exception):
+  pass
+
+# The server closed a reused connection before sending any of the response.
+# Usually it had already timed out the idle connection, so it's safe to try
+# again on a fresh one.
+class StaleConnectionError(Exception):
+  pass
+
+# Incrementally undoes a gzip or deflate content-encoding.
+class Decoder(object):
+  def __init__(self, encoding):
+    self.encoding = encoding
+    if encoding in ('gzip', 'x-gzip'):
+      self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+      self.obj = zlib.decompressobj()
+    self.started = False
+
+  def decompress(self, data):
+    try:
+      out = self.obj.decompress(data)
+    except zlib.error:
+      if self.started or self.encoding != 'deflate': raise
+      # Some servers send a raw deflate stream without the zlib header.
+      self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+      out = self.obj.decompress(data)
+    self.started = self.started or bool(data)
+    return out
+
+  def flush(self):
+    return self.obj.flush()
+
+DECODERS = ('gzip', 'x-gzip', 'deflate')
+
+# Undoes Transfer-Encoding: chunked. Each piece of the body is passed to
+# deliver as soon as it arrives.
+class ChunkedDecoder(object):
+  def __init__(self, deliver):
+    self.deliver = deliver
+    self.state = 'size'
+    self.buffer = ''
+    self.remaining = 0
+
+  # Returns None until the last chunk and any trailers have been read, then
+  # returns whatever data came after them.
+  def write(self, data):
+    self.buffer += data
+    while True:
+      if self.state == 'body':
+        if not self.buffer: return None
+        if len(self.buffer) <= self.remaining:
+          part, self.buffer = self.buffer, ''
+        else:
+          part = self.buffer[:self.remaining]
+          self.buffer = self.buffer[self.remaining:]
+        self.remaining -= len(part)
+        self.deliver(part)
+        if not self.remaining: self.state = 'crlf'
+        continue
+
+      if self.state == 'crlf':
+        if len(self.buffer) < 2: return None
+        if self.buffer[:2] != '\r\n':
+          raise ChunkedEncodingError('missing CRLF after chunk')
+        self.buffer = self.buffer[2:]
+        self.state = 'size'
+        continue
+
+      i = self.buffer.find('\r\n')
+      if i < 0: return None
+      line, self.buffer = self.buffer[:i], self.buffer[i + 2:]
+
+      if self.state == 'size':
+        try:
+          size = int(line.split(';', 1)[0].strip(), 16)
+        except ValueError:
+          raise ChunkedEncodingError('bad chunk size %r' % (line,))
+        if size:
+          self.state, self.remaining = 'body', size
+        else:
+          self.state = 'trailer'
+
+      elif not line: # end of trailers
+        rest, self.buffer = self.buffer, ''
+        self.state = 'done'
+        return rest
+
+NO_BODY_CODES = (204, 304)
+
+# Only these are ever pipelined, since they can be safely sent again if the
+# connection drops before they are answered.
+IDEMPOTENT = ('GET', 'HEAD')
+
+inf = float('inf')
+
+# Body consumers: if a request has a consumer, it is called with the status
+# and headers once they arrive. If it returns an object, that object's write
+# method is called with each piece of the decoded body as it comes in, and the
+# response's body is None. Nothing is buffered in that case.
 class Protocol(http.HTTPClient):
   status = None
+  consumer = None
+  decoder = None
+  chunked = None
+  reusable = False
+  response_started = False
+  idle_call = None
   _promise = None
+  _timers = ()
+  _number = 0
 
   def __init__(self, host, port):
     self.state = 'new'
     self.host = host
     self.port = port
     self.close_notify = defer.Deferred()
+    self.requests_sent = 0
+    # Requests already sent and waiting behind the current one, as
+    # (request, promise, number) tuples. Only used when pipelining.
+    self.pipeline = deque()
 
   def connectionMade(self):
     if self.state == 'waiting-for-connection':
@@ -51,28 +172,67 @@ class Protocol(http.HTTPClient):
       self._proceed()
       return promise
 
+    if self.pipeline_room(request.pipeline, inf) > 0:
+      number = self._send(request, promise)
+      self.pipeline.append((request, promise, number))
+      return promise
+
     promise.errback(InvalidStateError())
     return
 
+  # How many more requests could be pipelined behind the ones already sent,
+  # allowing depth in total. Pipeline says whether the new request may be.
+  def pipeline_room(self, pipeline, depth):
+    if self.state != 'busy': return 0
+    if not pipeline or not self._request.pipeline: return 0
+    if self.status and self.length is None and not self.chunked: return 0
+    if self.headers and not self.reusable: return 0
+    return depth - 1 - len(self.pipeline)
+
   def _proceed(self):
+    self._begin(self._request, self._promise, None)
+    self._number = self._send(self._request, self._promise)
+
+  # Resets everything about the response we are reading.
+  def _begin(self, request, promise, number):
+    self._request = request
+    self._promise = promise
+    self._number = number
     self.firstLine = 1 # tell the superclass that it's a new connection
     self.length = None # tell the superclass that it's a new connection
+    self._header = '' # the superclass never clears its last header line
     self.content_length, self.content_progress = 0, 0
     self.headers = {}
     self.chunks = []
     self.status = None
+    self.consumer = None
+    self.decoder = None
+    self.decode_error = None
+    self.body_bytes = 0
+    self.chunked = None
+    self.reusable = False
+    self.response_started = False
 
     self.state = 'busy'
-    self._promise.emit('connected')
+    self.start_timers(self._request.timeouts)
 
-    self.sendCommand(self._request.method, str(self._request.path))
-    for k, v in self._request.headers.items():
+  # Writes the request and returns its number on this connection.
+  def _send(self, request, promise):
+    self.requests_sent += 1
+    promise.emit('connected')
+
+    self.sendCommand(request.method, str(request.path))
+    for k, v in request.headers.items():
       self.sendHeader(str(k), str(v))
     self.endHeaders()
-    if self._request.body is not None:
-      self.transport.write(str(self._request.body))
+    if request.body is not None:
+      self.transport.write(str(request.body))
+
+    promise.emit('sent')
+    return self.requests_sent
 
-    self._promise.emit('sent')
+  def sendCommand(self, command, path):
+    self.transport.write('%s %s HTTP/1.1\r\n' % (command, path))
 
   def handleStatus(self, version, code, message):
     assert self.state == 'busy'
@@ -89,38 +249,201 @@ class Protocol(http.HTTPClient):
 
   def handleEndHeaders(self):
     assert self.state == 'busy'
+    self.stop_timer('headers')
+    connection = self.headers.get('connection', '').lower()
+    if self.status.http_version == 'HTTP/1.0':
+      self.reusable = connection == 'keep-alive'
+    else:
+      self.reusable = connection != 'close'
+
+    transfer = self.headers.get('transfer-encoding', '').strip().lower()
+    if not self.has_body:
+      self.length = 0 # whatever content-length says, nothing follows
+    elif transfer and transfer != 'identity':
+      self.length = None # chunked framing wins over content-length
+      self.chunked = ChunkedDecoder(self.handleResponsePart)
+    elif self.length is None:
+      self.reusable = False # the body ends when the connection does
+
+    encoding = self.headers.get('content-encoding', '').strip().lower()
+    if encoding in DECODERS:
+      self.decoder = Decoder(encoding)
+    if self._request.consumer:
+      self.consumer = self._request.consumer(self.status, self.headers)
     self._promise.emit('headers', self.headers)
 
+  # Progress is counted in bytes on the wire, since that's what
+  # content-length measures.
   def handleResponsePart(self, chunk):
     assert self.state == 'busy'
-    self.chunks.append(chunk)
     self.content_progress += len(chunk)
+    if self.decoder and not self.decode_error:
+      try:
+        self.deliver(self.decoder.decompress(chunk))
+      except zlib.error, ex:
+        self.decode_error = DecodingError(str(ex))
+    elif not self.decoder:
+      self.deliver(chunk)
     self._promise.emit('body', self.content_progress, self.content_length)
 
+  def dataReceived(self, data):
+    if self.state == 'busy':
+      self.response_started = True
+      self.restart_timer('read')
+    http.HTTPClient.dataReceived(self, data)
+
+  # Each timeout that isn't None gets a timer. headers and body count from
+  # when the request is sent; read counts from the last data received.
+  def start_timers(self, timeouts):
+    self._timers = {}
+    for name, seconds in zip(timeouts._fields, timeouts):
+      if seconds is not None:
+        self._timers[name] = reactor.callLater(seconds, self.timed_out, name)
+
+  def restart_timer(self, name):
+    if name in self._timers and self._timers[name].active():
+      seconds = getattr(self._request.timeouts, name)
+      self._timers[name].reset(seconds)
+
+  def stop_timer(self, name):
+    if name in self._timers:
+      timer = self._timers.pop(name)
+      if timer.active(): timer.cancel()
+
+  def stop_timers(self):
+    for name in list(self._timers):
+      self.stop_timer(name)
+
+  def timed_out(self, name):
+    self._timers.pop(name, None)
+    seconds = getattr(self._request.timeouts, name)
+    self.fail(error.TimeoutError(string='no %s within %ss' % (name, seconds)))
+
+  # Gives up on a request. If it's the one being read, that means closing
+  # the connection. If it's still waiting in the pipeline, its response will
+  # be read and thrown away.
+  def abort(self, reason, promise):
+    for i, (request, queued, number) in enumerate(self.pipeline):
+      if queued is promise:
+        discard = util.EventEmitter()
+        discard.addErrback(lambda reason: None)
+        self.pipeline[i] = request, discard, number
+        promise.errback(reason)
+        return
+    if self.state == 'busy' and promise is self._promise:
+      self.fail(reason)
+
+  @property
+  def is_healthy(self):
+    if self.state != 'idle': return False
+    return not getattr(self.transport, 'disconnecting', False)
+
+  @property
+  def has_body(self):
+    code = self.status.code
+    if self._request.method == 'HEAD': return False
+    return not (100 <= code < 200 or code in NO_BODY_CODES)
+
+  def lineReceived(self, line):
+    http.HTTPClient.lineReceived(self, line)
+    # The superclass only notices the end of a response when body data
+    # arrives, so a response with no body has to be finished here.
+    if not line and self.state == 'busy' and self.status and self.length == 0:
+      self.handleResponseEnd()
+      self.setLineMode()
+
+  def rawDataReceived(self, data):
+    if not self.chunked:
+      return http.HTTPClient.rawDataReceived(self, data)
+
+    try:
+      rest = self.chunked.write(data)
+    except ChunkedEncodingError, ex:
+      self.fail(ex)
+      return
+
+    if rest is not None:
+      self.chunked = None
+      self.handleResponseEnd()
+      self.setLineMode(rest)
+
+  def fail(self, reason):
+    self.stop_timers()
+    self.reusable = False
+    if self._promise:
+      promise = self._promise
+      del self._promise
+      promise.errback(reason)
+    self.fail_pipeline(reason)
+    self.transport.loseConnection()
+
+  # Requests in the pipeline never got any response, so they are safe to
+  # send again elsewhere.
+  def fail_pipeline(self, reason):
+    while self.pipeline:
+      request, promise, number = self.pipeline.popleft()
+      promise.errback(StaleConnectionError(reason))
+
+  def deliver(self, data):
+    if not data: return
+    self.body_bytes += len(data)
+    if self.consumer:
+      self.consumer.write(data)
+    else:
+      self.chunks.append(data)
+
   def handleResponseEnd(self):
     assert self.state == 'busy'
     self.complete()
 
   def connectionLost(self, reason):
-    self.state == 'closed'
+    self.stop_timers()
+    self.state = 'closed'
     self.close_notify.errback(reason)
 
-    if reason.check(error.ConnectionDone) and self.status:
+    # A body with no length ends when the connection does. Anything else is
+    # cut short.
+    if reason.check(error.ConnectionDone) and self.status and \
+        self.length is None and not self.chunked:
       self.complete()
 
     if self._promise:
       promise = self._promise
       del self._promise
+      if self._number > 1 and not self.response_started:
+        reason = StaleConnectionError(reason)
       promise.errback(reason)
+    self.fail_pipeline(reason)
 
   def complete(self):
+    self.stop_timers()
     if self._promise:
-      body = ''.join(self.chunks)
-      resp = Response(self.status, self.headers, body)
+      if self.decoder and not self.decode_error:
+        try:
+          self.deliver(self.decoder.flush())
+        except zlib.error, ex:
+          self.decode_error = DecodingError(str(ex))
+      if self.consumer:
+        body = None # the consumer already has it
+      else:
+        body = ''.join(self.chunks)
+      stats = Stats(self.content_progress, self.body_bytes)
+      resp = Response(self.status, self.headers, body, stats)
       promise = self._promise
       del self._promise
-      self.state = 'idle'
-      promise.callback(resp)
+      if self.state == 'busy':
+        if self.reusable and self.pipeline:
+          self._begin(*self.pipeline.popleft())
+        elif self.reusable:
+          self.state = 'idle'
+        else:
+          self.state = 'closing'
+          self.fail_pipeline(ConnectionDone())
+          self.transport.loseConnection()
+      if self.decode_error:
+        promise.errback(self.decode_error)
+      else:
+        promise.callback(resp)
 
 
 
@@ -132,16 +455,60 @@ class Client(object):
   max_connections = 50
   max_connections_per_domain = 6
 
+  # How many requests may be outstanding on one connection. Above 1, GET and
+  # HEAD requests that find every connection to their host busy are sent
+  # behind the ones already in flight instead of waiting. Only turn this on
+  # for servers known to handle pipelining properly.
+  pipeline_depth = 1
+
+  # Idle keep-alive connections are closed after this many seconds, and each
+  # pool keeps at most this many of them.
+  idle_timeout = 30
+  max_idle_per_domain = 2
+
+  # Seconds to wait for a connection, for the response headers, for the
+  # whole response, and between reads. None means wait forever.
+  connect_timeout = 30
+  header_timeout = 60
+  body_timeout = 600
+  read_timeout = 60
+
   '''
     This interface is based somewhat on httplib2.
   '''
 
-  def __init__(self):
+  def __init__(self, dns=None):
+    self.dns = dns or resolver.shared
     self._pools = {}
-    self._pending = []
-
-  def request(self, uri, method='GET', body=None, headers=None):
-    promise = util.EventEmitter()
+    self._ready = deque()
+    self._scheduled = False
+    self.active = 0 # connections in use or being made, over all pools
+
+  # If consumer is given, it is called with the status and headers once they
+  # arrive. If it returns an object, that object's write method gets each part
+  # of the body as it comes in, and the response's body will be None.
+  # Timeouts default to the client's, and fail the request with
+  # twisted.internet.error.TimeoutError. Cancelling the returned promise drops
+  # the request, closing its connection if it had started. Pass
+  # pipeline=False for requests that may take long to answer (like a long
+  # poll), so nothing gets pipelined behind them.
+  def request(self, uri, method='GET', body=None, headers=None, consumer=None,
+      header_timeout=None, body_timeout=None, read_timeout=None,
+      pipeline=True):
+    def cancel(promise):
+      cancelled[0] = True
+      if current[0]:
+        conn, sent = current[0]
+        conn.abort(defer.CancelledError(), sent)
+      elif waiting[0]:
+        self._pool((host, port)).cancel_waiting(waiting[0])
+
+    def fail(reason):
+      if not promise.called:
+        promise.errback(reason)
+
+    promise = util.EventEmitter(cancel)
+    cancelled, current, waiting = [False], [None], [None]
 
     split_uri = urlparse.urlsplit(uri)
     scheme, netloc, uri_path, query, fragment = split_uri
@@ -163,37 +530,67 @@ class Client(object):
     headers.setdefault('host', host + ('' if port == 80 else ':%d' % port))
     headers.setdefault('user-agent', 'Feedie')
     headers.setdefault('connection', 'Keep-Alive')
+    headers.setdefault('accept-encoding', 'gzip, deflate')
     if body is not None:
       body = str(body)
       headers.setdefault('content-length', str(len(body)))
 
-    d = self._get_connection((host, port))
+    timeouts = Timeouts(
+      header_timeout or self.header_timeout,
+      body_timeout or self.body_timeout,
+      read_timeout or self.read_timeout,
+    )
+    pipeline = pipeline and method in IDEMPOTENT
 
-    @d.addCallback
-    def d(conn):
-      assert conn.state in ('new', 'idle')
-      d = conn.request(Request(method, request_path, headers, body))
-      if conn.state != 'waiting-for-connection':
-        promise.emit('connected')
-      d.chainEvents(promise)
+    # A request that fails on a reused connection before any response arrives
+    # gets one more try on a fresh connection.
+    def attempt(fresh):
+      d = waiting[0] = self._get_connection((host, port), fresh, pipeline)
 
-      @d.addBoth
-      def d(x):
-        try:
+      @d.addCallback
+      def d(conn):
+        waiting[0] = None
+        if cancelled[0]:
           self._free_connection(conn)
-        except Exception, ex:
-          pass
-        return x
-
-      d.chainDeferred(promise)
+          return
+
+        assert conn.state in ('new', 'idle', 'busy')
+        d = conn.request(Request(method, request_path, headers, body,
+            consumer, timeouts, pipeline))
+        current[0] = conn, d
+        if conn.state != 'waiting-for-connection':
+          promise.emit('connected')
+        d.chainEvents(promise)
+
+        @d.addBoth
+        def d(x):
+          current[0] = None
+          try:
+            self._free_connection(conn)
+          except Exception, ex:
+            pass
+          return x
+
+        def failed(reason):
+          if reason.check(StaleConnectionError) and not fresh:
+            self._pool((host, port)).stale_retries += 1
+            attempt(True)
+          else:
+            fail(reason)
+
+        d.addCallbacks(promise.callback, failed)
+
+      d.addErrback(fail)
+      d.chainEvents(promise)
 
-    d.addErrback(promise.errback) # can't happen
-    d.chainEvents(promise)
+    attempt(False)
     return promise
 
-  def _get_connection(self, point):
+  def _get_connection(self, point, fresh=False, pipeline=False):
     promise = util.EventEmitter()
-    self._pending.append((point, promise))
+    pool = self._pool(point)
+    pool.waiting.append((promise, fresh, pipeline))
+    self._mark_ready(pool)
     self._process_connections()
     return promise
 
@@ -202,50 +599,37 @@ class Client(object):
     pool = self._pool(point)
     pool.free_connection(conn)
 
+  # Pools with someone waiting and room to start a request sit in
+  # self._ready, so dispatch never has to look at pools that can't go.
+  def _mark_ready(self, pool):
+    if pool.is_ready and not pool.in_ready:
+      pool.in_ready = True
+      self._ready.append(pool)
+
+  # Called by pools whenever their connections change. Coalesces into one
+  # pass over the ready pools per reactor tick.
+  def _connections_changed(self, pool):
+    self._mark_ready(pool)
+    if not self._scheduled:
+      self._scheduled = True
+      reactor.callLater(0, self._process_connections)
+
   def _process_connections(self):
-    while True:
-      promise, conn = self._get_next()
-      if promise is None: break
-      if promise == 'retry': continue
-      promise.callback(conn)
+    self._scheduled = False
+    while self._ready and self.active < self.max_connections:
+      pool = self._ready.popleft()
+      pool.in_ready = False
+      if not pool.is_ready: continue
+      pool.start_next()
+      self._mark_ready(pool)
 
   @property
   def count_active_connections(self):
-    return sum(map(lambda x: len(x.in_use) + len(x.making),
-                   self._pools.values()))
-
-  def _get_next(self):
-    def make_conn_for_promise(pool, promise):
-      promise.emit('connecting')
-      d = pool.make_conn()
-      @d.addCallback
-      def d(conn):
-        pool.in_use.append(conn)
-        promise.callback(conn)
-      #d.chainDeferred(promise)
-      d.addErrback(promise.errback)
-
-    if self.count_active_connections >= self.max_connections:
-      return None, None
-
-    for i, (point, promise) in enumerate(self._pending):
-      pool = self._pool(point)
-      if len(pool.in_use) >= self.max_connections_per_domain:
-        continue
-
-      if pool.available:
-        conn = pool.available.pop()
-        assert conn.state == 'idle'
-        pool.in_use.append(conn)
-        del self._pending[i]
-        return promise, conn
+    return self.active
 
-      elif not pool.making:
-        del self._pending[i]
-        make_conn_for_promise(pool, promise)
-        return 'retry', None
-
-    return None, None
+  # Returns per-host connection stats, keyed by (host, port).
+  def stats(self):
+    return dict([(point, pool.stats()) for point, pool in self._pools.items()])
 
   def _pool(self, point):
     if point not in self._pools:
@@ -253,49 +637,211 @@ class Client(object):
     return self._pools[point]
 
 class Pool(object):
+  in_ready = False
+
   def __init__(self, client, point):
     self.client = client
     self.host, self.port = point
-    self.in_use = []
+    self.waiting = deque()
+    self.in_use = set()
     self.available = []
     self.making = []
     self.creator = protocol.ClientCreator(reactor, Protocol, *point)
+    self.requests = 0
+    self.reused = 0
+    self.evictions = 0
+    self.stale_retries = 0
+    self.pipelined = 0
+
+  @property
+  def is_ready(self):
+    if not self.waiting: return False
+    promise, fresh, pipeline = self.waiting[0]
+    # Below the cap a request waits for a connection of its own, even while
+    # one is being made, rather than queueing behind another request.
+    if len(self.in_use) < self.client.max_connections_per_domain:
+      return bool((self.available and not fresh) or not self.making)
+    return self.pipeline_target(fresh, pipeline) is not None
+
+  # Returns the busy connection with the most room to pipeline a request
+  # onto, or None.
+  def pipeline_target(self, fresh, pipeline):
+    depth = self.client.pipeline_depth
+    if depth <= 1 or fresh or not pipeline: return None
+    best, best_room = None, 0
+    for conn in self.in_use:
+      room = conn.pipeline_room(pipeline, depth)
+      if room > best_room:
+        best, best_room = conn, room
+    return best
+
+  def stats(self):
+    return dict(requests=self.requests, reused=self.reused,
+        reuse_ratio=float(self.reused) / (self.requests or 1),
+        evictions=self.evictions, stale_retries=self.stale_retries,
+        idle=len(self.available), pipelined=self.pipelined)
+
+  def cancel_waiting(self, promise):
+    for entry in list(self.waiting):
+      if entry[0] is promise:
+        self.waiting.remove(entry)
+
+  def start_next(self):
+    promise, fresh, pipeline = self.waiting.popleft()
+    self.requests += 1
+    while self.available and not fresh:
+      conn = self.available.pop()
+      self.stop_idling(conn)
+      if not conn.is_healthy:
+        self.evict(conn)
+        continue
+      self.reused += 1
+      self.use(conn)
+      promise.callback(conn)
+      return
+
+    if len(self.in_use) >= self.client.max_connections_per_domain:
+      conn = self.pipeline_target(fresh, pipeline)
+      if conn:
+        self.reused += 1
+        self.pipelined += 1
+        promise.callback(conn)
+        return
+
+    promise.emit('connecting')
+    d = self.make_conn()
+
+    @d.addCallback
+    def d(conn):
+      self.use(conn)
+      promise.callback(conn)
+
+    d.addErrback(promise.errback)
+
+  def use(self, conn):
+    self.in_use.add(conn)
+    self.client.active += 1
+
+  def unuse(self, conn):
+    if conn not in self.in_use: return False
+    self.in_use.remove(conn)
+    self.client.active -= 1
+    return True
 
   def free_connection(self, conn):
-    if conn in self.in_use:
-      self.in_use.remove(conn)
-      if conn not in self.available:
-        self.available.append(conn)
-    reactor.callLater(0, self.client._process_connections)
+    if conn.state == 'busy': # still answering pipelined requests
+      pass
+    elif self.unuse(conn):
+      if conn.state == 'idle' and conn not in self.available:
+        self.start_idling(conn)
+    self.client._connections_changed(self)
+
+  def start_idling(self, conn):
+    self.available.append(conn)
+    conn.idle_call = reactor.callLater(self.client.idle_timeout,
+        self.idle_timed_out, conn)
+    while len(self.available) > self.client.max_idle_per_domain:
+      oldest = self.available.pop(0)
+      self.stop_idling(oldest)
+      self.evict(oldest)
+
+  def stop_idling(self, conn):
+    if conn.idle_call and conn.idle_call.active():
+      conn.idle_call.cancel()
+    conn.idle_call = None
+
+  def idle_timed_out(self, conn):
+    conn.idle_call = None
+    if conn in self.available:
+      self.available.remove(conn)
+      self.evict(conn)
+
+  def evict(self, conn):
+    self.evictions += 1
+    if conn.state == 'idle':
+      conn.state = 'closing'
+      conn.transport.loseConnection()
 
   def make_conn(self):
     promise = defer.Deferred()
 
-    d = self.creator.connectTCP(self.host, self.port, timeout=30)
+    d = self.client.dns.resolve(self.host)
+    d.addCallback(self.creator.connectTCP, self.port,
+        timeout=self.client.connect_timeout)
     self.making.append(d)
+    self.client.active += 1
+
+    def done_making():
+      if d in self.making:
+        self.making.remove(d)
+        self.client.active -= 1
 
     @d.addCallback
     def d(conn):
-      if d in self.making: self.making.remove(d)
+      done_making()
       close_notify = conn.close_notify
 
       @close_notify.addErrback
       def close_notify(reason):
-        if conn in self.in_use:
-          self.in_use.remove(conn)
+        self.unuse(conn)
         if conn in self.available:
           self.available.remove(conn)
-        reactor.callLater(0, self.client._process_connections)
+        self.stop_idling(conn)
+        self.client._connections_changed(self)
 
       assert conn.state == 'idle'
-      #self.available.append(conn)
       promise.callback(conn)
-      reactor.callLater(0, self.client._process_connections)
+      self.client._connections_changed(self)
 
     @d.addErrback
     def d(reason):
+      done_making()
       promise.errback(reason)
-      if d in self.making: self.making.remove(d)
-      reactor.callLater(0, self.client._process_connections)
+      self.client._connections_changed(self)
 
     return promise
+
+if __name__ == '__main__':
+  # Micro-benchmark: queue lots of requests over many hosts (ports, here) and
+  # check that the time per request stays flat as the queue grows. Then see
+  # what pipelining buys against one host.
+  import time
+  from twisted.protocols import basic
+
+  class StandIn(basic.LineReceiver):
+    def lineReceived(self, line):
+      if not line:
+        self.transport.write('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+
+  factory = protocol.ServerFactory()
+  factory.protocol = StandIn
+  ports = [reactor.listenTCP(0, factory, interface='127.0.0.1')
+           for i in range(20)]
+  uris = ['http://127.0.0.1:%d/' % p.getHost().port for p in ports]
+
+  @defer.inlineCallbacks
+  def run():
+    for n in (100, 1000, 5000):
+      client = Client()
+      start = time.time()
+      yield defer.DeferredList([client.request(uris[i % len(uris)])
+                                for i in range(n)])
+      elapsed = time.time() - start
+      print '%5d requests: %.3fs (%.1fus each)' % (n, elapsed,
+          elapsed / n * 1e6)
+
+    # Then the same against a single host, with and without pipelining.
+    for depth in (1, 4):
+      client = Client()
+      client.pipeline_depth = depth
+      n = 2000
+      start = time.time()
+      yield defer.DeferredList([client.request(uris[0]) for i in range(n)])
+      elapsed = time.time() - start
+      print 'depth %d, %d requests to one host: %.3fs (%.1fus each, ' \
+          '%d pipelined)' % (depth, n, elapsed, elapsed / n * 1e6,
+          client.stats()[('127.0.0.1', ports[0].getHost().port)]['pipelined'])
+    reactor.stop()
+
+  reactor.callWhenRunning(run)
+  reactor.run()
@@ -1,4 +1,5 @@
 import gtk
+from collections import OrderedDict
 
 DATA = {
   'blank': [
@@ -116,6 +117,44 @@ DATA = {
 
 PIXBUFS = {}
 
+class PixbufCache(object):
+  '''
+    Decoded favicons keyed by digest, so feeds sharing an icon share one
+    pixbuf and only icons that actually get drawn are decoded. The least
+    recently used are dropped once there are more than size.
+  '''
+
+  def __init__(self, size=512):
+    self.size = size
+    self.pixbufs = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  # Returns None if data isn't an image gtk can load.
+  def get(self, key, data):
+    if key in self.pixbufs:
+      self.hits += 1
+      pixbuf = self.pixbufs.pop(key)
+    else:
+      self.misses += 1
+      pixbuf = decode(data)
+      while len(self.pixbufs) >= self.size:
+        self.pixbufs.popitem(last=False)
+    self.pixbufs[key] = pixbuf
+    return pixbuf
+
+def decode(data, size=16):
+  try:
+    loader = gtk.gdk.PixbufLoader()
+    loader.set_size(size, size)
+    loader.write(data)
+    loader.close()
+    return loader.get_pixbuf()
+  except Exception:
+    return None
+
+favicons = PixbufCache()
+
 def get_pixbuf(name):
   if name not in PIXBUFS:
     data = DATA[name]
@@ -0,0 +1,159 @@
+import os
+try:
+  import simplejson as json
+except ImportError:
+  import json
+from twisted.internet import reactor, defer
+
+# Sets a post doc's read and starred fields from a journal state, which has
+# 'read' (with 'read_at') and/or 'starred'. Reading is relative to the doc's
+# own updated_at, so it's applied to whatever version is current.
+def apply_state(doc, state):
+  if 'read' in state:
+    if state['read']:
+      doc['read_updated_at'] = doc.get('updated_at', 0)
+      doc['read_at'] = state['read_at']
+    else:
+      doc.pop('read_updated_at', None)
+      doc.pop('read_at', None)
+  if 'starred' in state:
+    doc['starred'] = state['starred']
+
+# Write-behind for read and starred state. Callers update the post in memory
+# and record the change here, which appends it to a log file and returns
+# without waiting for CouchDB. Changes to the same post are coalesced, so
+# toggling it ten times is still one write.
+#
+# A flush saves everything pending in batches through modify_docs, a
+# flush_delay after the first change. Posts that keep conflicting are tried
+# again after retry_delay, as is everything if the flush can't reach CouchDB. Once nothing is in
+# flight the log is rewritten to hold just what's still pending, so if the
+# process dies the next start replays whatever didn't make it. Posts that
+# no longer exist (deleted by GC, or with their feed), or that CouchDB
+# refuses outright, are dropped.
+#
+# The log is flushed to the OS on every append but not fsynced; it's meant
+# to survive the process, not the machine.
+class Journal(object):
+  flush_delay = 0.5
+  retry_delay = 5
+
+  def __init__(self, db, path, clock=reactor):
+    self.db = db
+    self.path = path
+    self.clock = clock
+    self.pending = {} # post id -> state
+    self.in_flight = {}
+    self.log = None
+    self.flush_call = None
+    self.recorded = 0
+    self.coalesced = 0
+    self.flushed = 0
+    self.failures = 0
+    self.dropped = 0
+
+  # Reads back anything a previous run left in the log and flushes it.
+  def open(self):
+    if os.path.exists(self.path):
+      for line in open(self.path):
+        try:
+          post_id, state = json.loads(line)
+        except ValueError:
+          continue # a torn last line
+        self.merge(post_id, state)
+
+    self.compact()
+    if self.pending:
+      return self.flush()
+    return defer.succeed(None)
+
+  def merge(self, post_id, state):
+    if post_id in self.pending:
+      self.coalesced += 1
+      state = dict(self.pending[post_id], **state)
+    self.pending[post_id] = state
+
+  def record(self, post_id, **state):
+    self.recorded += 1
+    self.merge(post_id, state)
+    self.log.write(json.dumps([post_id, state]) + '\n')
+    self.log.flush()
+    self.schedule(self.flush_delay)
+
+  # Gives doc the state that hasn't been saved yet, if any. For docs coming
+  # from the database that don't know about it.
+  def overlay(self, doc):
+    post_id = doc['_id']
+    for states in (self.in_flight, self.pending):
+      if post_id in states:
+        apply_state(doc, states[post_id])
+
+  def schedule(self, delay):
+    if self.flush_call is None or not self.flush_call.active():
+      self.flush_call = self.clock.callLater(delay, self.flush)
+
+  @defer.inlineCallbacks
+  def flush(self):
+    if self.in_flight or not self.pending: return
+    if self.flush_call is not None and self.flush_call.active():
+      self.flush_call.cancel()
+
+    self.in_flight, self.pending = self.pending, {}
+    states = self.in_flight
+
+    # A doc reloaded after a conflict may have been deleted meanwhile; it
+    # comes back bare, and is left alone rather than saved again.
+    def modify(doc):
+      if '_rev' not in doc:
+        doc.clear()
+        return
+      apply_state(doc, states[doc['_id']])
+
+    given_up, failed = [], []
+    try:
+      docs = yield self.db.modify_docs(states.keys(), modify, load_first=True,
+          given_up=given_up, failed=failed)
+    except Exception:
+      self.failures += 1
+      given_up, failed = states.keys(), []
+      docs = []
+
+    self.flushed += len(docs)
+    self.dropped += len(states) - len(docs) - len(given_up)
+    if docs:
+      self.db.touch_view('feedie/feed_post_slim')
+    self.in_flight = {}
+    for post_id in given_up:
+      # anything recorded since is newer
+      self.pending[post_id] = dict(states[post_id],
+          **self.pending.get(post_id, {}))
+
+    self.compact()
+    if given_up:
+      self.schedule(self.retry_delay)
+    elif self.pending:
+      self.schedule(self.flush_delay)
+
+  # Rewrites the log to hold only what's pending.
+  def compact(self):
+    if self.log is not None:
+      self.log.close()
+    tmp = self.path + '.tmp'
+    f = open(tmp, 'w')
+    for post_id, state in self.pending.items():
+      f.write(json.dumps([post_id, state]) + '\n')
+    f.close()
+    os.rename(tmp, self.path)
+    self.log = open(self.path, 'a')
+
+  def close(self):
+    if self.flush_call is not None and self.flush_call.active():
+      self.flush_call.cancel()
+    if self.log is not None:
+      self.log.close()
+      self.log = None
+
+  def stats(self):
+    return dict(pending=len(self.pending), in_flight=len(self.in_flight),
+        recorded=self.recorded, coalesced=self.coalesced,
+        flushed=self.flushed, failures=self.failures, dropped=self.dropped)
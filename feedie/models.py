@@ -3,20 +3,32 @@ import cgi
 import time
 import couchdb
 import urlparse
+import base64
 import hashlib
 import feedparser
 import calendar
 import traceback
+import weakref
 import gtk
-from collections import defaultdict, namedtuple
+try:
+  import simplejson as json
+except ImportError:
+  import json
+from collections import defaultdict, namedtuple, OrderedDict
 from desktopcouch.records.record import Record
-from twisted.internet import reactor, defer, threads
+from twisted.internet import reactor, defer
 from twisted.internet import error as twisted_error
 
 from feedie import http
 from feedie import util
 from feedie import incoming
-from feedie.attrdict import attrdict
+from feedie import feedstream
+from feedie import parsing
+from feedie import scheduler
+from feedie import changes
+from feedie import images
+from feedie import journal
+from feedie.design_doc import slim_doc, summary_dict
 
 ONE_DAY = 24 * 60 * 60
 ONE_MONTH = 30 * ONE_DAY
@@ -35,17 +47,11 @@ class Transfer(object):
     self.progress = progress
     self.total = total
 
-class BodyHeadersHack(object):
-  def __init__(self, body, url):
-    self.body = body
-    self.url = url
-    self.href = url
-
-  def read(self):
-    return self.body
+# Replace this to change how feeds get parsed. See parsing.Executor.
+parse_executor = parsing.Executor()
 
 def parse_feed(body, uri):
-  return threads.deferToThread(feedparser.parse, BodyHeadersHack(body, uri))
+  return parse_executor.parse(body, uri)
 
 preferred=('text/html', 'application/xhtml+xml', 'text/plain')
 
@@ -73,23 +79,45 @@ def parse_http_datetime(s):
   except:
     return 0
 
+# Names are event names, or (name, key) pairs for keyed handlers, which
+# only hear events emitted for their key.
 class SignalRegistry(object):
   def __init__(self):
     self.map = {}
+    self.cache = {} # name -> handlers, until something registers or leaves
 
   def __getitem__(self, name):
     return self.map.setdefault(name, {})
 
   def register(self, name, handler):
     def unregister():
-      del self[name][id]
+      handlers = self.map[name]
+      del handlers[id]
+      if not handlers:
+        del self.map[name]
+      self.invalidate(name)
     assert callable(handler)
     id = object()
     self[name][id] = handler
+    self.invalidate(name)
     return unregister
 
-  def handlers(self, *names):
-    return sum([self[name].values() for name in names], [])
+  def invalidate(self, name):
+    if name == '*':
+      self.cache.clear()
+    else:
+      self.cache.pop(name, None)
+
+  # Handlers for name, plus the ones for every event unless it's keyed.
+  def handlers(self, name):
+    try:
+      return self.cache[name]
+    except KeyError:
+      handlers = self.map.get(name, {}).values()
+      if not isinstance(name, tuple):
+        handlers += self.map.get('*', {}).values()
+      self.cache[name] = handlers
+      return handlers
 
 class Model(object):
   def __model_init(self):
@@ -100,10 +128,36 @@ class Model(object):
     self.__model_init()
     return self.registry.register(name, handler)
 
+  # Handlers run on a later tick; see util.Dispatcher.
   def emit(self, name, *args, **kwargs):
     self.__model_init()
-    for handler in self.registry.handlers(name, '*'):
-      reactor.callLater(0, handler, self, name, *args, **kwargs)
+    util.dispatcher.emit(self, name, self.registry.handlers(name), args,
+        kwargs, pass_emitter=True)
+
+  # Like connect, but handler only hears name when it's emitted with
+  # emit_keyed for key. Returns a function that disconnects it.
+  def connect_keyed(self, name, key, handler):
+    self.__model_init()
+    return self.registry.register((name, key), handler)
+
+  def emit_keyed(self, name, key, *args, **kwargs):
+    self.__model_init()
+    util.dispatcher.emit(self, name, self.registry.handlers((name, key)),
+        args, kwargs, pass_emitter=True)
+
+# Every Post in memory, by id. Feeds own their posts. Everything else finds
+# them through here, so a post is one object wherever it shows up, and the
+# unread and starred lists are just sets of ids.
+live_posts = weakref.WeakValueDictionary()
+
+# Posts for the ids that are still in memory.
+def resolve_posts(post_ids):
+  posts = []
+  for post_id in post_ids:
+    post = live_posts.get(post_id)
+    if post is not None:
+      posts.append(post)
+  return posts
 
 class UnreadNewsSource(Model):
   is_removable = False
@@ -112,7 +166,7 @@ class UnreadNewsSource(Model):
   def __init__(self, db):
     self.db = db
     self.sources = None
-    self.posts = None
+    self.post_ids = None
     self.summary = dict(total=0, read=0, starred_total=0, starred_read=0)
     self.connect('summary-changed', self.update_rowref_unread)
 
@@ -121,53 +175,53 @@ class UnreadNewsSource(Model):
 
   def added_to(self, sources):
     def posts_marked_read(sources, event_name, posts):
-      if self.posts is None: return
+      if self.post_ids is None: return
 
       for post in posts:
-        if post._id in self.posts:
-          del self.posts[post._id]
+        if post._id in self.post_ids:
+          self.post_ids.remove(post._id)
           self.emit('post-removed', post)
           if post.starred:
             self.summary['starred_total'] -= 1
 
-      self.summary['total'] = len(self.posts)
+      self.summary['total'] = len(self.post_ids)
       self.emit('summary-changed')
 
     def posts_marked_unread(sources, event_name, posts):
-      if self.posts is None: return
+      if self.post_ids is None: return
 
       for post in posts:
-        self.posts[post._id] = post
+        self.post_ids.add(post._id)
         self.emit('posts-added', [post])
         if post.starred:
           self.summary['starred_total'] += 1
 
-      self.summary['total'] = len(self.posts)
+      self.summary['total'] = len(self.post_ids)
       self.emit('summary-changed')
 
     def posts_added(sources, event_name, feed, posts):
-      if self.posts is None: return
+      if self.post_ids is None: return
       added_here = []
       for post in posts:
         if not post.read:
-          if post._id not in self.posts:
-            self.posts[post._id] = post
+          if post._id not in self.post_ids:
+            self.post_ids.add(post._id)
             added_here.append(post)
             if post.starred:
               self.summary['starred_total'] += 1
       if added_here:
         self.emit('posts-added', added_here)
-      self.summary['total'] = len(self.posts)
+      self.summary['total'] = len(self.post_ids)
       self.emit('summary-changed')
 
     def post_removed(sources, event_name, feed, post):
-      if self.posts is None: return
-      if post._id in self.posts:
-        del self.posts[post._id]
+      if self.post_ids is None: return
+      if post._id in self.post_ids:
+        self.post_ids.remove(post._id)
         self.emit('post-removed', post)
         if post.starred:
           self.summary['starred_total'] -= 1
-        self.summary['total'] = len(self.posts)
+        self.summary['total'] = len(self.post_ids)
         self.emit('summary-changed')
 
     self.sources = sources
@@ -217,24 +271,24 @@ class UnreadNewsSource(Model):
         map.setdefault(row['value']['feed_id'], []).append(row['value'])
       return map
 
-    if self.posts is None:
-      rows = yield self.db.view('feedie/unread_posts',
-          keys=self.sources.feed_ids)
-      by_feed = group(rows)
-      posts = {}
-      for feed_id, docs in by_feed.items():
+    def on_rows(rows):
+      for feed_id, docs in group(rows).items():
         feed = self.get_feed(feed_id)
         feed_posts = feed.upsert_posts(docs, update_summary=False)
-        posts.update(dict([(post._id, post) for post in feed_posts]))
-      self.posts = posts
-    defer.returnValue(self.posts.values())
+        post_ids.update([post._id for post in feed_posts])
+
+    if self.post_ids is None:
+      post_ids = set()
+      yield self.db.view_iter('feedie/unread_posts_slim', on_rows,
+          keys=self.sources.feed_ids)
+      self.post_ids = post_ids
+    defer.returnValue(resolve_posts(self.post_ids))
 
   def get_feed(self, feed_id):
     return self.sources.get_feed(feed_id)
 
   def get_post(self, post_id):
-    feed = self.get_feed(feed_id)
-    return feed.posts[post_id]
+    return live_posts[post_id]
 
   @property
   def sort_key(self):
@@ -271,7 +325,7 @@ class StarredNewsSource(Model):
   def __init__(self, db):
     self.db = db
     self.sources = None
-    self.posts = None
+    self.post_ids = None
     self.summary = dict(total=0, read=0, starred_total=0, starred_read=0)
     self.connect('summary-changed', self.update_rowref_unread)
 
@@ -321,20 +375,22 @@ class StarredNewsSource(Model):
 
   @defer.inlineCallbacks
   def post_summaries(self):
-    def row_to_entry(row):
-      doc = row['value']
-      return row['id'], self.get_feed(doc['feed_id']).post(doc)
-    if self.posts is None:
-      rows = yield self.db.view('feedie/starred_posts')
-      self.posts = dict(map(row_to_entry, rows))
-    defer.returnValue(self.posts.values())
+    def on_rows(rows):
+      for row in rows:
+        doc = row['value']
+        post_ids.add(self.get_feed(doc['feed_id']).post(doc)._id)
+
+    if self.post_ids is None:
+      post_ids = set()
+      yield self.db.view_iter('feedie/starred_posts_slim', on_rows)
+      self.post_ids = post_ids
+    defer.returnValue(resolve_posts(self.post_ids))
 
   def get_feed(self, feed_id):
     return self.sources.get_feed(feed_id)
 
   def get_post(self, post_id):
-    feed = self.get_feed(feed_id)
-    return feed.posts[post_id]
+    return live_posts[post_id]
 
   @property
   def sort_key(self):
@@ -416,8 +472,9 @@ class Preferences(Model):
 
 class Sources(Model):
   def __init__(self, db, http_client, icon_http_client, throttle, prefs,
-      treestore):
+      treestore, journal):
     self.db = db
+    self.journal = journal
     self.http_client = http_client
     self.icon_http_client = icon_http_client
     self.throttle = throttle
@@ -429,7 +486,20 @@ class Sources(Model):
     self.doc = dict(_id=self._id)
     self.builtin_order = []
     self.needs_refresh = []
-
+    self.scheduler = scheduler.Scheduler()
+    self.mirror = changes.Mirror(self)
+    self.reconciled_at = 0
+    self.loaded_feeds = OrderedDict() # feed id -> feed, least recent first
+    self.post_index_hits = 0
+    self.post_index_misses = 0
+    self.post_index_evictions = 0
+    self.posts_held = 0 # in all feeds' posts; Feed keeps it up to date
+
+    # One handler for every post, instead of one per post.
+    def post_changed_starred(post, event_name, starred, read):
+      post.feed.post_changed_starred(post, event_name, starred, read)
+    self.disconnect_post_starred = Post.connect_all('changed::starred',
+        post_changed_starred)
 
     news_row = ('', 'NEWS', 0, 0, 0, 0, None, True, '')
     self.news_iter = self.treestore.append(None, row=news_row)
@@ -450,6 +520,9 @@ class Sources(Model):
       feed.__disconnect_summary_changed = feed.connect('summary-changed',
           summary_changed)
 
+      if feed.subscribed:
+        self.scheduler.add(feed)
+
     self.connect('feed-added', feed_added_helper)
 
     def feed_removed_helper(sources, event_name, feed):
@@ -462,6 +535,13 @@ class Sources(Model):
       (feed.__disconnect_summary_changed or (lambda:None))()
       feed.__disconnect_summary_changed = None
 
+      self.scheduler.remove(feed)
+      self.loaded_feeds.pop(feed.id, None)
+
+      for disconnect in feed.disconnect_marked:
+        disconnect()
+      feed.disconnect_marked = []
+
       for post in feed.posts.values():
         self.emit('post-removed', feed, post)
 
@@ -488,6 +568,7 @@ class Sources(Model):
       )
       yield self.add_subscriptions(subs)
 
+    since = yield self.mirror.current_seq()
     rows = yield self.db.view('feedie/feed')
 
     summary_rows = yield Feed.load_summaries(self.db, [r['id'] for r in rows])
@@ -495,15 +576,46 @@ class Sources(Model):
 
     docs = [r['value'] for r in rows]
     self.upsert_feeds(docs, summaries=summaries)
+    self.reconciled_at = time.time()
 
+    self.mirror.start(since)
+    self.scheduler.start()
     self.housekeeping()
 
+  # Refreshing is driven by self.scheduler, which wakes up only when some
+  # feed's expires_at comes due. This is just for garbage collection.
   @defer.inlineCallbacks
   def housekeeping(self):
     yield self.collect_garbage()
-    self.refresh_all()
+    if time.time() - self.reconciled_at >= self.RECONCILE_INTERVAL:
+      yield self.reconcile_summaries()
     reactor.callLater(60, self.housekeeping)
 
+  # Feed summaries are kept up to date from local events and the changes
+  # feed. Every RECONCILE_INTERVAL seconds they're checked against the
+  # summary view anyway, in one query, in case something slipped by. Feeds
+  # whose posts are all in memory are counted from those instead.
+  RECONCILE_INTERVAL = 15 * 60
+
+  def reconcile_summaries(self):
+    self.reconciled_at = time.time()
+    return self.reload_summaries(self.feeds.values())
+
+  # Sets each feed's summary from its posts if they're all in memory and
+  # kept current, else from the summary view, in one query for all of them.
+  @defer.inlineCallbacks
+  def reload_summaries(self, feeds):
+    mirrored = self.mirror.healthy
+    queried = [f for f in feeds if not (mirrored and f.posts_loaded)]
+    summary_rows = yield Feed.load_summaries(self.db, [f.id for f in queried])
+    summaries = dict(summary_rows)
+    for feed in feeds:
+      if mirrored and feed.posts_loaded:
+        feed.set_summary(feed.summary_of_posts())
+      else:
+        feed.set_summary(summaries.get(feed.id) or
+            dict(total=0, read=0, starred_total=0, starred_read=0))
+
   def refresh_all(self):
     return self.refresh_feeds(self.subscribed_feeds)
 
@@ -558,7 +670,14 @@ class Sources(Model):
     for row in rows:
       revs[row['id']] = row['value']
 
-    yield self.db.modify_docs(revs.keys(), modify, load_first=True)
+    docs = yield self.db.modify_docs(revs.keys(), modify, load_first=True)
+
+    # Loaded feeds don't have to wait for the changes feed to drop these.
+    for doc in docs:
+      feed = self.feeds.get(doc.get('feed_id'))
+      post = feed and feed.posts.get(doc['_id'])
+      if post is not None:
+        feed.remove_post(post)
 
   # This code must be careful not to retry modifications.
   #
@@ -576,13 +695,11 @@ class Sources(Model):
 
     revs = {}
     rows = yield self.db.view('feedie/deleted_feeds')
+    if not rows: return
+    summary_rows = yield Feed.load_summaries(self.db, [r['id'] for r in rows])
+    totals = dict([(id, summary['total']) for id, summary in summary_rows])
     for row in rows:
-      summaries = yield Feed.load_summaries(self.db, [row['id']])
-      if summaries:
-        id, summary = summaries[0]
-      else:
-        summary = dict(total=0, read=0, starred_total=0, starred_read=0)
-      if summary['total'] == 0:
+      if not totals.get(row['id']):
         revs[row['id']] = row['value']['_rev']
 
     yield self.db.modify_docs(revs.keys(), modify, load_first=True)
@@ -704,9 +821,22 @@ class Sources(Model):
         new_feeds.append(feed)
 
     self.emit('sources-added', new_feeds)
+    if new_feeds:
+      self.load_favicons(new_feeds)
 
     return feeds
 
+  # Loads the favicons saved with these feeds, many per request.
+  @defer.inlineCallbacks
+  def load_favicons(self, feeds):
+    feeds = [feed for feed in feeds if feed.has_saved_favicon]
+    for i in range(0, len(feeds), self.FAVICON_BATCH_SIZE):
+      group = feeds[i:i + self.FAVICON_BATCH_SIZE]
+      by_id = dict([(feed.id, feed) for feed in group])
+      found = yield self.db.get_attachments(by_id.keys(), 'favicon_data')
+      for feed_id, favicon_data in found.items():
+        by_id[feed_id].loaded_favicon(favicon_data)
+
   def get_feed(self, feed_id):
     return self.feeds[feed_id]
 
@@ -766,51 +896,60 @@ class Sources(Model):
       if path:
         self.treestore.remove(self.treestore.get_iter(path))
 
-  BATCH_SIZE = 113
+  FAVICON_BATCH_SIZE = 250
 
-  @defer.inlineCallbacks
-  def mark_posts_as(self, posts, read, split='auto', now=None):
-    if split == 'auto':
-      split = len(posts) > self.BATCH_SIZE
-
-    if split:
-      groups = util.groups_of(self.BATCH_SIZE, posts)
-      for group in groups:
-        yield self.mark_posts_as(group, read, split=False, now=now)
-      return
+  # Feeds keep their posts loaded between selections, kept current by the
+  # changes feed and by our own writes. Once feeds hold more than
+  # POST_BUDGET posts between them (a few hundred bytes each), the least
+  # recently shown are unloaded until they don't, or only the latest is
+  # left. Unloading keeps unread and starred posts, which still count.
+  POST_BUDGET = 100000
 
+  def feed_posts_used(self, feed, hit):
+    if hit:
+      self.post_index_hits += 1
+    else:
+      self.post_index_misses += 1
+
+    self.loaded_feeds.pop(feed.id, None)
+    self.loaded_feeds[feed.id] = feed
+    while self.posts_held > self.POST_BUDGET and len(self.loaded_feeds) > 1:
+      feed_id, lru = self.loaded_feeds.popitem(last=False)
+      lru.unload_posts()
+      self.post_index_evictions += 1
+
+  def post_index_stats(self):
+    return dict(hits=self.post_index_hits, misses=self.post_index_misses,
+        evictions=self.post_index_evictions, feeds=len(self.loaded_feeds),
+        posts=self.posts_held)
+
+  # Changes the posts in memory and leaves saving them to the journal.
+  def mark_posts_as(self, posts, read, now=None):
     if now is None:
       now = int(time.time())
 
+    state = dict(read=read)
     if read:
-      def modify(doc):
-        when = doc.get('updated_at', 0)
-        doc['read_updated_at'] = when
-        doc['read_at'] = now
-    else:
-      def modify(doc):
-        if 'read_updated_at' in doc:
-          del doc['read_updated_at']
-        if 'read_at' in doc:
-          del doc['read_at']
+      state['read_at'] = now
 
     # We only care about ones that need changing
     posts = [post for post in posts if post.read != read]
+    for post in posts:
+      post.apply_state(state)
+      self.journal.record(post._id, **state)
 
-    ids = [post._id for post in posts]
-    docs = [post.doc.copy() for post in posts]
-    docs = yield self.db.modify_docs(ids, modify, docs=docs)
-
-    # update each post with current doc from the db
-    for post, doc in zip(posts, docs):
-      post.doc = doc
-
-    if read:
-      self.emit('posts-marked-read', posts)
-    else:
-      self.emit('posts-marked-unread', posts)
+    self.emit_posts_marked(read, posts)
 
-    self.db.touch_view('feedie/feed_post')
+  # Each feed hears about its own posts only, keyed by feed id. Everything
+  # else hears about them all.
+  def emit_posts_marked(self, read, posts):
+    event = ('posts-marked-unread', 'posts-marked-read')[read]
+    by_feed = defaultdict(list)
+    for post in posts:
+      by_feed[post.feed.id].append(post)
+    for feed_id, feed_posts in by_feed.iteritems():
+      self.emit_keyed(event, feed_id, feed_posts)
+    self.emit(event, posts)
 
 count_load_summaries = 0
 
@@ -819,9 +958,15 @@ class Feed(Model):
   is_refreshing = False
   rowref = None
   spin_start = 0
-  favicon_data = None
+  _favicon_data = None
+  favicon_key = None
   _doc = None
 
+  # True once self.posts holds every post in the feed. From then on the
+  # changes feed keeps it current, so it isn't queried again unless
+  # Sources.feed_posts_used unloads it to stay within POST_BUDGET.
+  posts_loaded = False
+
   def __init__(self, sources, doc, summary=None):
     self.sources = sources
     self.db = sources.db
@@ -829,9 +974,12 @@ class Feed(Model):
     self.doc = doc
     self.posts = {}
     self.summary = summary or dict(total=0, read=0, starred_total=0, starred_read=0)
-    self.load_favicon()
-    sources.connect('posts-marked-read', self.posts_marked_read)
-    sources.connect('posts-marked-unread', self.posts_marked_unread)
+    self.disconnect_marked = [
+      sources.connect_keyed('posts-marked-read', self.id,
+          self.posts_marked_read),
+      sources.connect_keyed('posts-marked-unread', self.id,
+          self.posts_marked_unread),
+    ]
     self.connect('favicon-changed', self.update_rowref_icon)
     self.connect('summary-changed', self.update_rowref_unread)
     self.connect('progress-changed', self.update_rowref_progress)
@@ -853,10 +1001,16 @@ class Feed(Model):
   def __len__(self):
     return self.summary['total']
 
+  # Unlike get_posts, makes sure the post has its full doc.
   @defer.inlineCallbacks
   def load_post(self, post_id):
     x = yield self.get_posts([post_id])
-    defer.returnValue(x[0])
+    post = x[0]
+    if post.is_slim:
+      doc = yield self.db.load_doc(post_id)
+      self.sources.journal.overlay(doc)
+      post.doc = doc
+    defer.returnValue(post)
 
   @defer.inlineCallbacks
   def get_posts(self, post_ids):
@@ -867,26 +1021,31 @@ class Feed(Model):
     pass
 
   # Return a list of (uri, summary) pairs. Each summary is a small dictionary.
+  # Feeds with no posts are left out.
   @staticmethod
   @defer.inlineCallbacks
   def load_summaries(db, keys):
+    if not keys: defer.returnValue([])
     rows = yield db.view('feedie/summary', group='true', keys=keys)
-    defer.returnValue([(x['key'], x['value']) for x in rows])
+    defer.returnValue([(x['key'], summary_dict(x['value'])) for x in rows])
 
-  @defer.inlineCallbacks
-  def update_summary(self):
-    old = self.summary
-    self.summary = yield self.load_summary()
-    if self.summary != old:
+  def set_summary(self, summary):
+    if summary != self.summary:
+      self.summary = summary
       self.emit('summary-changed')
 
-  @defer.inlineCallbacks
-  def load_summary(self):
-    summaries = yield Feed.load_summaries(self.db, [self.id])
-    for id, summary in summaries:
-      if id == self.id:
-        defer.returnValue(summary)
-    defer.returnValue(dict(total=0, read=0, starred_total=0, starred_read=0))
+  # Same as the summary view, from the posts in memory.
+  def summary_of_posts(self):
+    summary = dict(total=0, read=0, starred_total=0, starred_read=0)
+    for post in self.posts.values():
+      summary['total'] += 1
+      if post.read:
+        summary['read'] += 1
+      if post.starred:
+        summary['starred_total'] += 1
+        if post.read:
+          summary['starred_read'] += 1
+    return summary
 
   @property
   def transfers(self):
@@ -907,7 +1066,7 @@ class Feed(Model):
     return 100 * progress / total
 
   @defer.inlineCallbacks
-  def fetch(self, uri, http=None, icon=False):
+  def fetch(self, uri, http=None, icon=False, consumer=None):
     def on_connecting(*args):
       self.transfers.append(transfer)
       in_list[0] = True
@@ -953,7 +1112,7 @@ class Feed(Model):
       client = self.sources.icon_http_client
     else:
       client = self.sources.http_client
-    d = client.request(uri, headers=headers)
+    d = client.request(uri, headers=headers, consumer=consumer)
     transfer = Transfer(progress=0, total=0)
     in_list = [False]
     if not icon:
@@ -1009,7 +1168,7 @@ class Feed(Model):
     http['expires_at'] = max(http['expires_at'], now + min_max_age)
 
   @defer.inlineCallbacks
-  def save_ifeed(self, ifeed, response):
+  def save_ifeed(self, ifeed, response, counter=None):
     def modify(doc):
       doc['link'] = ifeed.link
       doc['title'] = ifeed.title
@@ -1020,7 +1179,8 @@ class Feed(Model):
       self.modify_http(doc.setdefault('http', {}), response, 1800)
 
     yield self.modify(modify)
-    yield self.throttle.save_iposts.run(self.save_iposts, ifeed.posts)
+    yield self.throttle.save_iposts.run(self.save_iposts, ifeed.posts,
+        counter)
     defer.returnValue(None)
 
   @defer.inlineCallbacks
@@ -1076,6 +1236,22 @@ class Feed(Model):
     other = yield other.refresh()
     defer.returnValue(other)
 
+  # Parse feeds as they download, saving posts in batches. See feedstream.
+  stream_parse = True
+
+  def stream_consumer(self, uri, counter):
+    def save_batch(parsed):
+      iposts = list(incoming.Feed(parsed).posts)
+      return self.throttle.save_iposts.run(self.save_iposts, iposts, counter)
+
+    def consumer(status, headers):
+      if status.code != 200: return None
+      stream[0] = feedstream.Parser(uri, parse_feed, save_batch)
+      return stream[0]
+
+    stream = [None]
+    return consumer, stream
+
   @defer.inlineCallbacks
   def refresh(self, force=False):
     if not (force or self.ready_for_refresh):
@@ -1089,8 +1265,12 @@ class Feed(Model):
 
       uri = self.doc['source_uri']
       http_info = self.doc.get('http', None)
+      counter = [0]
+      consumer, stream = None, [None]
+      if self.stream_parse:
+        consumer, stream = self.stream_consumer(uri, counter)
       try:
-        response = yield self.fetch(uri, http_info)
+        response = yield self.fetch(uri, http_info, consumer=consumer)
       except http.BadURIError:
         yield self.save_error('bad-uri')
         self.emit('favicon-changed')
@@ -1123,7 +1303,10 @@ class Feed(Model):
         defer.returnValue(self)
 
       uri = self.doc['source_uri']
-      parsed = yield parse_feed(response.body, uri)
+      if stream[0]:
+        parsed = yield stream[0].close()
+      else:
+        parsed = yield parse_feed(response.body, uri)
 
       if not parsed.version: # not a feed
         if 'links' not in parsed.feed:
@@ -1142,19 +1325,22 @@ class Feed(Model):
         defer.returnValue((yield self.redirect(links[0].href, **extra)))
 
       ifeed = incoming.Feed(parsed)
-      yield self.save_ifeed(ifeed, response)
+      yield self.save_ifeed(ifeed, response, counter)
       self.discover_favicon(ifeed)
       defer.returnValue(self)
 
     finally:
       self.is_refreshing = False
 
+  # Fires once the icon's uri is known, or with wait, once the icon itself
+  # has been fetched too.
   @defer.inlineCallbacks
-  def discover_favicon(self, ifeed=None):
+  def discover_favicon(self, ifeed=None, wait=False):
     # We already got some. Maybe some day we'll try again.
     if 'icon_uri' in self.doc:
-      # No yield! We don't want to wait on the result.
+      # Only yield if asked to; refreshes don't wait on the result.
       d = self.refresh_favicon()
+      if wait: yield d
       return
 
     uri = yield self.discover_favicon_uri(ifeed)
@@ -1165,8 +1351,9 @@ class Feed(Model):
 
     yield self.modify(modify)
 
-    # No yield! We don't want to wait on the result.
+    # Only yield if asked to; refreshes don't wait on the result.
     d = self.refresh_favicon()
+    if wait: yield d
 
   @defer.inlineCallbacks
   def discover_favicon_uri(self, ifeed=None):
@@ -1234,7 +1421,7 @@ class Feed(Model):
 
   @defer.inlineCallbacks
   def put_favicon(self, favicon_data):
-    if hasattr(self, 'favicon_data') and self.favicon_data == favicon_data:
+    if self.favicon_data == favicon_data:
       return
     while True:
       try:
@@ -1271,15 +1458,7 @@ class Feed(Model):
   def update_rowref_icon(self, *args):
     if self.rowref:
       if self.favicon_data:
-        try:
-          loader = gtk.gdk.PixbufLoader()
-          loader.set_size(16, 16)
-          loader.write(self.favicon_data)
-          loader.close()
-          icon = loader.get_pixbuf()
-        except:
-          theme = gtk.icon_theme_get_default()
-          icon = theme.load_icon(self.icon, 16, 0)
+        icon = None # decoded when drawn, see favicon_pixbuf
       else:
         theme = gtk.icon_theme_get_default()
         icon = theme.load_icon(self.icon, 16, 0)
@@ -1287,13 +1466,34 @@ class Feed(Model):
       path = self.rowref.get_path()
       model[path][6] = icon
 
-  @defer.inlineCallbacks
-  def load_favicon(self):
-    if '_attachments' not in self.doc: return
-    att = self.doc['_attachments']
-    if 'favicon_data' not in att: return
-    self.favicon_data = yield self.db.get_attachment(self.id, 'favicon_data')
-    self.emit('favicon-changed')
+  @property
+  def favicon_data(self):
+    return self._favicon_data
+
+  # The key matches the digest CouchDB gives the attachment.
+  @favicon_data.setter
+  def favicon_data(self, data):
+    self._favicon_data = data
+    self.favicon_key = None
+    if data:
+      self.favicon_key = 'md5-' + base64.b64encode(hashlib.md5(data).digest())
+
+  @property
+  def favicon_pixbuf(self):
+    if self.favicon_data:
+      pixbuf = images.favicons.get(self.favicon_key, self.favicon_data)
+      if pixbuf: return pixbuf
+    theme = gtk.icon_theme_get_default()
+    return theme.load_icon(self.icon, 16, 0)
+
+  @property
+  def has_saved_favicon(self):
+    return 'favicon_data' in self.doc.get('_attachments', {})
+
+  def loaded_favicon(self, favicon_data):
+    if self.favicon_data is None:
+      self.favicon_data = favicon_data
+      self.emit('favicon-changed')
 
   @defer.inlineCallbacks
   def reject_favicon(self):
@@ -1329,31 +1529,43 @@ class Feed(Model):
   def error(self):
     return self.doc.get('error', None)
 
-  def post_changed_starred(self, post, event_name):
-    self.update_summary()
+  # starred and read are as they were when it changed; by the time this
+  # runs, the post may have changed again.
+  def post_changed_starred(self, post, event_name, starred, read):
+    change = (-1, 1)[starred]
+    self.summary['starred_total'] += change
+    if read:
+      self.summary['starred_read'] += change
+    self.emit('summary-changed')
 
+  # Only gets this feed's posts; see Sources.emit_posts_marked.
   def posts_marked_read(self, sources, event_name, posts):
-    our_count = 0
     for post in posts:
-      if post.feed is self:
-        our_count += 1
-        self.summary['read'] += 1
-        if post.starred:
-          self.summary['starred_read'] += 1
-    if our_count:
-      self.emit('summary-changed')
+      self.summary['read'] += 1
+      if post.starred:
+        self.summary['starred_read'] += 1
+    self.emit('summary-changed')
 
   def posts_marked_unread(self, sources, event_name, posts):
-    our_count = 0
     for post in posts:
-      if post.feed is self:
-        our_count += 1
-        self.summary['read'] -= 1
-        if post.starred:
-          self.summary['starred_read'] -= 1
-    if our_count:
-      self.emit('summary-changed')
+      self.summary['read'] -= 1
+      if post.starred:
+        self.summary['starred_read'] -= 1
+    self.emit('summary-changed')
+
 
+  def remove_post(self, post):
+    if self.posts.pop(post._id, None) is None: return
+    self.sources.posts_held -= 1
+    self.summary['total'] -= 1
+    if post.read:
+      self.summary['read'] -= 1
+    if post.starred:
+      self.summary['starred_total'] -= 1
+      if post.read:
+        self.summary['starred_read'] -= 1
+    self.emit('post-removed', post)
+    self.emit('summary-changed')
 
   # Retrieves the posts. If each one does not exist, creates it using
   # the appropriate element in default_doc.
@@ -1362,9 +1574,16 @@ class Feed(Model):
     new_posts = []
     for default_doc in default_docs:
       post_id = default_doc['_id']
-      if post_id not in self.posts:
-        post = self.posts[post_id] = Post(default_doc, self)
-        post.connect('changed::starred', self.post_changed_starred)
+      post = self.posts.get(post_id)
+      if post is None:
+        post = live_posts.get(post_id)
+        if post is None:
+          self.sources.journal.overlay(default_doc)
+          post = live_posts[post_id] = Post(default_doc, self)
+        else:
+          post.feed = self # may be left from before it was resubscribed
+        self.posts[post_id] = post
+        self.sources.posts_held += 1
 
         if update_summary:
           self.summary['total'] += 1
@@ -1376,7 +1595,7 @@ class Feed(Model):
               self.summary['starred_read'] += 1
 
         new_posts.append(post)
-      posts.append(self.posts[post_id])
+      posts.append(post)
 
     if new_posts:
       self.emit('posts-added', new_posts)
@@ -1389,8 +1608,10 @@ class Feed(Model):
   def post(self, default_doc):
     return self.upsert_posts([default_doc])[0]
 
+  # counter holds the number of posts already taken from this feed, when
+  # they arrive in several batches.
   @defer.inlineCallbacks
-  def save_iposts(self, iposts):
+  def save_iposts(self, iposts, counter=None):
     now = int(time.time())
     def modify(doc):
       ipost = by_id[doc['_id']]
@@ -1413,22 +1634,22 @@ class Feed(Model):
       doc['tags'] = ipost.tags
       doc['comments'] = ipost.comments
 
+    if counter is None: counter = [0]
     by_id = {}
-    count = 0
     for ipost in iposts:
       if not ipost.has_useful_updated_at: continue
-      if count >= 2 and ipost.updated_at < now - ONE_MONTH: continue
+      if counter[0] >= 2 and ipost.updated_at < now - ONE_MONTH: continue
       post_id = short_hash('%s %s' % (self.id, ipost.id))
       by_id[post_id] = ipost
-      count += 1
+      counter[0] += 1
 
     docs = yield self.db.modify_docs(by_id.keys(), modify)
 
-    posts = self.upsert_posts(docs)
+    posts = self.upsert_posts(map(slim_doc, docs))
     for post, doc in zip(posts, docs):
-      post.doc = doc
+      post.update_doc(doc)
 
-    self.db.touch_view('feedie/feed_post')
+    self.db.touch_view('feedie/feed_post_slim')
 
   @property
   def id(self):
@@ -1448,8 +1669,35 @@ class Feed(Model):
 
   @defer.inlineCallbacks
   def check_posts_loaded(self):
-    rows = yield self.db.view('feedie/feed_post', key=self.id)
-    self.posts = dict([(row['id'], self.post(row['value'])) for row in rows])
+    hit = self.posts_loaded and self.sources.mirror.healthy
+    if not hit:
+      yield self.load_posts()
+    self.sources.feed_posts_used(self, hit)
+
+  @defer.inlineCallbacks
+  def load_posts(self):
+    def on_rows(rows):
+      seen.update([row['id'] for row in rows])
+      self.upsert_posts([row['value'] for row in rows], update_summary=False)
+
+    # Updated in place, so posts already handed out stay the ones in here.
+    seen = set()
+    yield self.db.view_iter('feedie/feed_post_slim', on_rows, key=self.id)
+    for post_id in self.posts.keys():
+      if post_id not in seen:
+        del self.posts[post_id]
+        self.sources.posts_held -= 1
+    self.posts_loaded = True
+    self.set_summary(self.summary_of_posts())
+
+  # Lets go of the posts only a full load needed: read and unstarred. The
+  # unread and starred lists may be showing the rest.
+  def unload_posts(self):
+    self.posts_loaded = False
+    for post_id, post in self.posts.items():
+      if post.read and not post.starred:
+        del self.posts[post_id]
+        self.sources.posts_held -= 1
 
   @defer.inlineCallbacks
   def post_summaries(self):
@@ -1544,68 +1792,169 @@ class Feed(Model):
       self.doc = yield self.db.modify_doc(self.id, modify, doc=self.doc)
     self.emit('deleted')
 
-class Post(Model):
+# Which slot holds each hot field: the ones post lists, sorting and the
+# read and starred logic look at. A missing field is None.
+HOT_POST_SLOTS = {
+  '_id': '_id',
+  '_rev': '_rev',
+  'title': 'title',
+  'updated_at': 'updated_at',
+  'read_updated_at': '_read_updated_at',
+  'read_at': '_read_at',
+  'starred': '_starred',
+}
+
+# A post keeps its hot fields in slots and everything else (content,
+# summary_detail, tags and so on) as one JSON string, decoded when asked
+# for. feed_id comes from the feed. There's no per-post dict or registry,
+# so a post costs a few hundred bytes instead of a few kilobytes.
+#
+# Handlers are kept in Post.signals, shared by every post. Ones connected
+# with connect_all hear the event from every post.
+class Post(object):
+  __slots__ = ('feed', 'slim', 'cold', '__weakref__') + \
+      tuple(HOT_POST_SLOTS.values())
+
+  signals = SignalRegistry()
+
+  # (cold, decoded) for the last post whose cold fields were asked for,
+  # since opening a post asks for several.
+  last_cold = (None, {})
+
   def __init__(self, doc, feed):
-    self.doc = doc
     self.feed = feed
+    self.set_doc(doc)
+
+  @classmethod
+  def connect_all(cls, name, handler):
+    return cls.signals.register(name, handler)
+
+  def connect(self, name, handler):
+    return self.signals.register((name, self._id), handler)
+
+  # Handlers run on a later tick; see util.Dispatcher.
+  def emit(self, name, *args, **kwargs):
+    handlers = self.signals.handlers(name)
+    keyed = self.signals.map.get((name, self._id))
+    if keyed:
+      handlers = handlers + keyed.values()
+    util.dispatcher.emit(self, name, handlers, args, kwargs,
+        pass_emitter=True)
 
   def __getitem__(self, name):
-    return self.doc[name]
+    slot = HOT_POST_SLOTS.get(name)
+    if slot is not None:
+      value = getattr(self, slot)
+      if value is None: raise KeyError(name)
+      return value
+    if name == 'feed_id':
+      return self.feed.id
+    if name == 'slim':
+      if not self.slim: raise KeyError(name)
+      return True
+    return self.cold_doc()[name]
 
   def __setitem__(self, name, value):
-    self.doc[name] = value
+    doc = self.doc
+    doc[name] = value
+    self.doc = doc
 
   def __contains__(self, name):
-    return name in self.doc
+    try:
+      self[name]
+      return True
+    except KeyError:
+      return False
 
+  def get(self, name, default=None):
+    try:
+      return self[name]
+    except KeyError:
+      return default
+
+  def cold_doc(self):
+    if self.cold is None: return {}
+    cold, doc = Post.last_cold
+    if cold is not self.cold:
+      doc = json.loads(self.cold)
+      Post.last_cold = self.cold, doc
+    return doc
+
+  def hot_doc(self):
+    doc = {}
+    for key, slot in HOT_POST_SLOTS.iteritems():
+      value = getattr(self, slot)
+      if value is not None:
+        doc[key] = value
+    return doc
+
+  def set_hot(self, doc):
+    for key, slot in HOT_POST_SLOTS.iteritems():
+      setattr(self, slot, doc.get(key))
+
+  # A new dict each time; changing it changes nothing until it's assigned
+  # back.
   @property
   def doc(self):
-    return self._doc
+    doc = dict(self.cold_doc())
+    doc.update(self.hot_doc())
+    doc['feed_id'] = self.feed.id
+    if self.slim:
+      doc['slim'] = True
+    return doc
 
-  @property
-  def _id(self):
-    return self.doc['_id']
+  @doc.setter
+  def doc(self, new):
+    old_read = self.read
+    self.set_doc(new)
+    if self.read != old_read:
+      self.emit('changed::read')
+
+  def set_doc(self, doc):
+    self.set_hot(doc)
+    self.slim = doc.get('slim', False)
+    cold = dict([(k, v) for k, v in doc.iteritems()
+        if k not in HOT_POST_SLOTS and k not in ('feed_id', 'slim')])
+    self.cold = json.dumps(cold, separators=(',', ':')) if cold else None
+
+  # Sets read and starred from a journal state, leaving cold fields alone.
+  def apply_state(self, state):
+    old_read = self.read
+    doc = self.hot_doc()
+    journal.apply_state(doc, state)
+    self.set_hot(doc)
+    if self.read != old_read:
+      self.emit('changed::read')
 
+  # Posts listed from the slim views only have SLIM_POST_KEYS until
+  # Feed.load_post fetches the rest.
   @property
-  def title(self):
-    return self.doc['title']
+  def is_slim(self):
+    return self.slim
+
+  # Replaces the doc with a newly saved version, staying slim if it was.
+  # Read and starred changes the journal hasn't saved yet are kept.
+  def update_doc(self, doc):
+    self.feed.sources.journal.overlay(doc)
+    if self.is_slim:
+      doc = slim_doc(doc)
+    self.doc = doc
 
   @property
   def link(self):
-    return self.doc['link']
+    return self['link']
 
   @property
   def feed_id(self):
-    return self.doc['feed_id']
+    return self.feed.id
 
   @property
   def content(self):
-    return self.doc['content']
+    return self['content']
 
   @property
   def summary_detail(self):
-    return self.doc['summary_detail']
-
-  @property
-  def updated_at(self):
-    return self.doc['updated_at']
-
-  @doc.setter
-  def doc(self, new):
-    if not hasattr(self, '_doc'):
-      self._doc = attrdict(new)
-      return
-
-    old_read = self.read
-
-    old = self._doc
-    if old != new:
-      self._doc = attrdict(new)
-
-    new_read = self.read
-
-    if old_read != new_read:
-      self.emit('changed::read')
+    return self['summary_detail']
 
   def base(self):
     post_domain = urlparse.urlsplit(self.link).netloc
@@ -1631,32 +1980,106 @@ class Post(Model):
 
   @defer.inlineCallbacks
   def modify(self, modify):
-    self.doc = yield self.feed.db.modify_doc(self._id, modify, doc=self.doc)
+    if self.is_slim:
+      doc = yield self.feed.db.modify_doc(self._id, modify, load_first=True)
+    else:
+      doc = yield self.feed.db.modify_doc(self._id, modify, doc=self.doc)
+    self.update_doc(doc)
 
   def toggle_read_updated_at(self, sources):
     return sources.mark_posts_as([self], read=not self.read)
 
   @property
   def read_updated_at(self):
-    return self.doc.get('read_updated_at', 0)
+    return self._read_updated_at or 0
 
   @property
   def read(self):
     return self.read_updated_at >= self.updated_at
 
-  @defer.inlineCallbacks
   def toggle_starred(self):
-    def modify(doc):
-      doc['starred'] = new_starred
-
-    was_starred = self.starred
-    new_starred = not self.starred
-    yield self.modify(modify)
-    now_starred = self.starred
-
-    if was_starred != now_starred: # always true
-      self.emit('changed::starred')
+    starred = not self.starred
+    self.apply_state(dict(starred=starred))
+    self.feed.sources.journal.record(self._id, starred=starred)
+    self.emit('changed::starred', starred, self.read)
 
   @property
   def starred(self):
-    return self.doc.get('starred', False)
+    return self._starred or False
+
+if __name__ == '__main__':
+  # Memory benchmark: posts held the way they used to be (an attrdict doc
+  # and a registry of their own with one handler) against Post, for docs
+  # from the slim views and full ones.
+  import sys
+  from feedie.attrdict import attrdict
+
+  class OldPost(Model):
+    def __init__(self, doc, feed):
+      self.doc = attrdict(doc)
+      self.feed = feed
+
+  class FakeFeed(object):
+    id = 'feed-0123456789abcdef'
+
+  def make_doc(i, full):
+    doc = dict(_id='post-%016x' % i, _rev='1-%032x' % i, feed_id=FakeFeed.id,
+        title='Post number %d' % i, updated_at=1300000000 + i,
+        starred=(i % 7 == 0))
+    if i % 2:
+      doc['read_updated_at'] = doc['updated_at']
+    if not full:
+      doc['slim'] = True
+      return doc
+    doc.update(type='post', link='http://example.com/posts/%d' % i,
+        summary_detail=dict(type='text/html', value='<p>Summary</p>' * 20),
+        content=[dict(type='text/html', value='<p>Content</p>' * 60)],
+        author_detail=dict(name='Someone', email='someone@example.com'),
+        tags=[dict(term='tag%d' % t) for t in range(3)],
+        read_at=1300000000)
+    return doc
+
+  def deep_size(root, skip):
+    seen = set(map(id, skip))
+    total = 0
+    stack = [root]
+    while stack:
+      x = stack.pop()
+      if id(x) in seen: continue
+      seen.add(id(x))
+      total += sys.getsizeof(x)
+      if isinstance(x, dict):
+        stack.extend(x.keys())
+        stack.extend(x.values())
+      elif isinstance(x, (list, tuple, set, frozenset)):
+        stack.extend(x)
+      else:
+        if hasattr(x, '__dict__'):
+          stack.append(x.__dict__)
+        for slot in getattr(type(x), '__slots__', ()):
+          if hasattr(x, slot):
+            stack.append(getattr(x, slot))
+    return total
+
+  feed = FakeFeed()
+  handler = lambda post, event_name: None
+  skip = [feed, handler]
+  for n in (10000, 100000):
+    for full in (False, True):
+      # as decoded from a view response, so nothing is shared between docs
+      docs = [json.loads(json.dumps(make_doc(i, full))) for i in xrange(n)]
+      old = []
+      for doc in docs:
+        post = OldPost(doc, feed)
+        post.connect('changed::starred', handler)
+        old.append(post)
+      old_size = deep_size(old, skip)
+      del old
+
+      new = [Post(doc, feed) for doc in docs]
+      new_size = deep_size(new, skip)
+      del docs, new
+
+      print '%6d %-4s old %6.1f MB  new %6.1f MB  (%d vs %d bytes per post)' % (
+          n, ('slim', 'full')[full], old_size / 1e6, new_size / 1e6,
+          old_size / n, new_size / n)
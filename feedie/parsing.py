@@ -0,0 +1,189 @@
+import time
+import cPickle
+import feedparser
+from collections import defaultdict
+from twisted.internet import reactor, defer, threads
+try:
+  import multiprocessing
+except ImportError:
+  multiprocessing = None
+
+# These are the only parts of a feedparser result that incoming.Feed,
+# incoming.Post and models.Feed ever look at. Everything else is dropped so
+# results are small and cheap to send between processes.
+FEED_KEYS = tuple('''
+
+  title subtitle link links icon author_detail updated_parsed
+
+'''.split())
+
+POST_KEYS = tuple('''
+
+  id link title updated_parsed created_parsed published_parsed published
+  summary_detail author_detail content contributors tags comments
+
+'''.split())
+
+class BodyHeadersHack(object):
+  def __init__(self, body, url):
+    self.body = body
+    self.url = url
+    self.href = url
+
+  def read(self):
+    return self.body
+
+# Like attrdict, but missing attributes raise AttributeError, same as
+# feedparser's dicts.
+class Record(dict):
+  def __getattr__(self, name):
+    try:
+      return self[name]
+    except KeyError:
+      raise AttributeError(name)
+
+# Turns feedparser's dicts (which may be UserDicts) and struct_times into
+# plain, picklable values.
+def plain(x):
+  if hasattr(x, 'keys'):
+    return dict([(k, plain(x[k])) for k in x.keys()])
+  if isinstance(x, (list, tuple, time.struct_time)):
+    return [plain(y) for y in x]
+  return x
+
+def pick(d, keys):
+  return dict([(k, plain(d[k])) for k in keys if k in d])
+
+def compact(parsed):
+  return dict(
+    version=parsed.get('version', ''),
+    feed=pick(parsed.get('feed', {}), FEED_KEYS),
+    entries=[pick(entry, POST_KEYS) for entry in parsed.get('entries', [])],
+  )
+
+def wrap(x):
+  if isinstance(x, dict):
+    return Record([(k, wrap(v)) for k, v in x.items()])
+  if isinstance(x, list):
+    return [wrap(y) for y in x]
+  return x
+
+# Runs in the worker process. Returns (ok, value, started, finished).
+def parse_compact(body, uri):
+  started = time.time()
+  try:
+    value = True, compact(feedparser.parse(BodyHeadersHack(body, uri)))
+  except Exception, ex:
+    value = False, repr(ex)
+  return value + (started, time.time())
+
+# Runs in a worker process. The result goes back already pickled, so one
+# that can't be pickled becomes a failure here instead of being lost.
+def parse_pickled(body, uri):
+  started = time.time()
+  try:
+    return cPickle.dumps(parse_compact(body, uri), 2)
+  except BaseException, ex:
+    return cPickle.dumps((False, repr(ex), started, time.time()), 2)
+
+class ParseError(Exception):
+  pass
+
+class Stats(object):
+  def __init__(self):
+    self.count = 0
+    self.wait = 0.0
+    self.parse = 0.0
+
+class Executor(object):
+  '''
+    Parses small bodies inline and sends the rest to a thread. Results are
+    compact records with the same shape as a feedparser result.
+  '''
+
+  # Below this many bytes, parsing takes less time than handing it off.
+  inline_limit = 16 * 1024
+
+  def __init__(self):
+    self.stats = defaultdict(Stats)
+
+  def parse(self, body, uri):
+    submitted = time.time()
+    if len(body) <= self.inline_limit:
+      d = defer.maybeDeferred(parse_compact, body, uri)
+    else:
+      d = self.submit(body, uri)
+
+    @d.addCallback
+    def d((ok, value, started, finished)):
+      stats = self.stats[uri]
+      stats.count += 1
+      stats.wait += started - submitted
+      stats.parse += finished - started
+      if not ok: raise ParseError(value)
+      return wrap(value)
+
+    return d
+
+  def submit(self, body, uri):
+    return threads.deferToThread(parse_compact, body, uri)
+
+  def close(self):
+    pass
+
+class ProcessExecutor(Executor):
+  '''
+    Like Executor, but large bodies go to a pool of worker processes so
+    parsing a refresh wave isn't stuck behind the GIL.
+
+    Python 2's pool never reports a worker that dies or hangs; its job just
+    never finishes. So each job gets timeout seconds, after which the pool is
+    taken to be broken: it's shut down, and that job, the others still out
+    and everything after go to threads instead.
+  '''
+
+  timeout = 120
+
+  def __init__(self, processes=None):
+    Executor.__init__(self)
+    self.processes = processes
+    self.pool = None
+    self.broken = False
+    self.jobs = {} # promise -> (body, uri, timer)
+
+  def submit(self, body, uri):
+    if multiprocessing is None or self.broken:
+      return Executor.submit(self, body, uri)
+
+    def done(result):
+      if promise not in self.jobs: return # already handed to a thread
+      self.jobs.pop(promise)[2].cancel()
+      promise.callback(cPickle.loads(result))
+
+    promise = defer.Deferred()
+    try:
+      if self.pool is None:
+        self.pool = multiprocessing.Pool(self.processes)
+      # The callback runs in the pool's result thread.
+      self.pool.apply_async(parse_pickled, (body, uri),
+          callback=lambda x: reactor.callFromThread(done, x))
+    except Exception:
+      self.break_pool()
+      return Executor.submit(self, body, uri)
+
+    timer = reactor.callLater(self.timeout, self.break_pool)
+    self.jobs[promise] = body, uri, timer
+    return promise
+
+  def break_pool(self):
+    self.broken = True
+    jobs, self.jobs = self.jobs, {}
+    self.close()
+    for promise, (body, uri, timer) in jobs.items():
+      if timer.active(): timer.cancel()
+      Executor.submit(self, body, uri).chainDeferred(promise)
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.terminate()
+      self.pool = None
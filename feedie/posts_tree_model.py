@@ -6,6 +6,7 @@ from twisted.internet import reactor, defer
 
 from feedie import images
 from feedie import util
+from feedie.models import Post
 
 class PostsTreeModel(gtk.GenericTreeModel):
   __gsignals__ = dict(sorted=(gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()))
@@ -40,6 +41,16 @@ class PostsTreeModel(gtk.GenericTreeModel):
     self.refs = {}
     self.sort_column_ids = []
     self.sort_direction = gtk.SORT_ASCENDING
+    self.disconnecters = [
+      Post.connect_all('changed::read', self.post_changed),
+      Post.connect_all('changed::starred', self.post_changed),
+    ]
+
+  # Stops listening to posts. Call it when the model is no longer shown.
+  def disconnect_posts(self):
+    for disconnecter in self.disconnecters:
+      disconnecter()
+    self.disconnecters = []
 
   def _insert_docs(self, docs):
     for doc in docs:
@@ -50,11 +61,10 @@ class PostsTreeModel(gtk.GenericTreeModel):
       self.docs[id] = doc
       self.refs[id] = n
       self.row_inserted(n, self.get_iter(n))
-      doc.connect('changed::read', self.post_changed)
-      doc.connect('changed::starred', self.post_changed)
     self._sort()
 
-  def post_changed(self, post, event_name):
+  def post_changed(self, post, event_name, *args):
+    if post._id not in self.refs: return
     n = self.on_get_path(post._id)
     self.row_changed(n, self.get_iter(n))
 
@@ -0,0 +1,68 @@
+from twisted.internet import reactor, defer, error
+from twisted.internet.abstract import isIPAddress
+
+# Caches hostname lookups. Failed lookups are cached for a shorter time, and
+# concurrent lookups of the same name share one query.
+#
+# The system resolver doesn't tell us record TTLs, so every answer gets the
+# same one.
+class Resolver(object):
+  ttl = 300
+  negative_ttl = 60
+
+  def __init__(self, clock=reactor):
+    self.clock = clock
+    self.cache = {} # name -> (expires_at, ip, failure)
+    self.in_flight = {} # name -> [deferred]
+    self.hits = 0
+    self.negative_hits = 0
+    self.misses = 0
+    self.joined = 0
+
+  def resolve(self, name):
+    if isIPAddress(name):
+      return defer.succeed(name)
+
+    now = self.clock.seconds()
+    if name in self.cache:
+      expires_at, ip, failure = self.cache[name]
+      if expires_at > now:
+        self.hits += 1
+        if failure:
+          self.negative_hits += 1
+          return defer.fail(failure.value)
+        return defer.succeed(ip)
+      del self.cache[name]
+
+    promise = defer.Deferred()
+    if name in self.in_flight:
+      self.joined += 1
+      self.in_flight[name].append(promise)
+      return promise
+
+    self.misses += 1
+    self.in_flight[name] = [promise]
+    d = self.clock.resolve(name)
+
+    @d.addCallback
+    def d(ip):
+      self.cache[name] = self.clock.seconds() + self.ttl, ip, None
+      for waiter in self.in_flight.pop(name):
+        waiter.callback(ip)
+
+    @d.addErrback
+    def d(failure):
+      if failure.check(error.DNSLookupError):
+        expires_at = self.clock.seconds() + self.negative_ttl
+        self.cache[name] = expires_at, None, failure
+      for waiter in self.in_flight.pop(name):
+        waiter.errback(failure.value)
+
+    return promise
+
+  def stats(self):
+    return dict(hits=self.hits, negative_hits=self.negative_hits,
+        misses=self.misses, joined=self.joined, size=len(self.cache))
+
+# Shared by every http.Client unless it's given its own.
+shared = Resolver()
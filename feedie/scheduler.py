@@ -0,0 +1,144 @@
+import heapq
+import random
+import urlparse
+from twisted.internet import reactor, defer
+
+# Keeps one entry per (feed, kind) in a heap ordered by when it is due, and
+# sleeps until the earliest one. Kind is 'http' for the feed itself and
+# 'icon_http' for its favicon, matching the doc keys that hold expires_at.
+#
+# Entries are never removed from the heap directly. Instead self.due holds the
+# current due time for each key, and heap entries that don't match it are
+# dropped when they reach the top.
+class Scheduler(object):
+  # Don't look at the same feed again sooner than this, even if its
+  # expires_at didn't move (e.g. the fetch failed before saving headers).
+  min_interval = 60
+
+  # Spread each wakeup over this many seconds so feeds that expire together
+  # don't all hit the network in the same tick.
+  jitter = 10
+
+  # Leave at least this many seconds between requests to the same host.
+  host_spacing = 2
+
+  def __init__(self, clock=reactor):
+    self.clock = clock
+    self.heap = []
+    self.due = {}
+    self.feeds = {}
+    self.host_next = {}
+    self.running = False
+    self.delayed_call = None
+    self.seq = 0
+    self.dispatched = 0
+    self.deferred_by_host = 0
+    self.last_lag = 0
+    self.max_lag = 0
+
+  def start(self):
+    self.running = True
+    self._wake()
+
+  def stop(self):
+    self.running = False
+    if self.delayed_call and self.delayed_call.active():
+      self.delayed_call.cancel()
+    self.delayed_call = None
+
+  def add(self, feed, when=None):
+    self.feeds[feed.id] = feed
+    self._push((feed.id, 'http'), feed.expires_at, when)
+    self._push((feed.id, 'icon_http'), feed.icon_expires_at, when)
+
+  def remove(self, feed):
+    self.feeds.pop(feed.id, None)
+    self.due.pop((feed.id, 'http'), None)
+    self.due.pop((feed.id, 'icon_http'), None)
+
+  def reschedule(self, feed, kind):
+    if feed.id not in self.feeds: return
+    now = self.clock.seconds()
+    expires_at = feed.doc.get(kind, {}).get('expires_at', 0)
+    self._push((feed.id, kind), expires_at, now + self.min_interval)
+
+  @property
+  def depth(self):
+    return len(self.due)
+
+  def stats(self):
+    return dict(depth=self.depth, dispatched=self.dispatched,
+        deferred_by_host=self.deferred_by_host, last_lag=self.last_lag,
+        max_lag=self.max_lag)
+
+  def _push(self, key, expires_at, not_before=None):
+    now = self.clock.seconds()
+    due = max(expires_at, not_before or 0)
+    if due <= now:
+      due = now
+    due += random.uniform(0, self.jitter)
+    self.due[key] = due
+    self.seq += 1
+    heapq.heappush(self.heap, (due, self.seq, key))
+    if self.running:
+      self._wake()
+
+  def _host(self, feed, kind):
+    if kind == 'icon_http':
+      uri = feed.doc.get('icon_uri', '') or feed.link
+    else:
+      uri = feed.doc.get('source_uri', '')
+    return urlparse.urlsplit(uri).hostname
+
+  def _wake(self):
+    while self.heap and self.due.get(self.heap[0][2]) != self.heap[0][0]:
+      heapq.heappop(self.heap) # stale entry
+
+    if not self.heap: return
+
+    delay = max(0, self.heap[0][0] - self.clock.seconds())
+    if self.delayed_call and self.delayed_call.active():
+      if self.delayed_call.getTime() <= self.clock.seconds() + delay: return
+      self.delayed_call.cancel()
+    self.delayed_call = self.clock.callLater(delay, self._run)
+
+  def _run(self):
+    self.delayed_call = None
+    now = self.clock.seconds()
+    while self.heap and self.heap[0][0] <= now:
+      due, seq, key = heapq.heappop(self.heap)
+      if self.due.get(key) != due: continue
+
+      feed_id, kind = key
+      feed = self.feeds[feed_id]
+      host = self._host(feed, kind)
+      if self.host_next.get(host, 0) > now:
+        self.deferred_by_host += 1
+        self.due[key] = self.host_next[host]
+        self.seq += 1
+        heapq.heappush(self.heap, (self.host_next[host], self.seq, key))
+        self.host_next[host] += self.host_spacing
+        continue
+      self.host_next[host] = now + self.host_spacing
+
+      del self.due[key]
+      self.dispatched += 1
+      self.last_lag = now - due
+      self.max_lag = max(self.max_lag, self.last_lag)
+      self._dispatch(feed, kind)
+
+    self._wake()
+
+  def _dispatch(self, feed, kind):
+    if kind == 'http':
+      d = feed.refresh()
+    elif feed.ready_for_refresh_favicon:
+      # Rescheduled only once the icon is fetched, else a feed with none
+      # yet would be sent again every min_interval until it arrived.
+      d = feed.discover_favicon(wait=True)
+    else:
+      d = defer.succeed(feed)
+
+    @d.addBoth
+    def d(x):
+      self.reschedule(feed, kind)
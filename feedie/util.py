@@ -3,6 +3,7 @@ from datetime import datetime
 from collections import defaultdict
 from twisted.internet.defer import Deferred
 from twisted.internet import reactor
+from twisted.python import log
 
 TIME_FORMATS = (
   '%Y-%m-%dT%H:%M:%S',
@@ -69,12 +70,76 @@ def mix(f, a, b):
 def leading(line_height, item_height):
   return line_height - item_height
 
+# Delivers events on a later reactor tick, the way one callLater(0, ...) per
+# handler used to, but with a single delayed call draining everything queued
+# in the meantime.
+#
+# Events named in collapsible never carry arguments and only say "look
+# again", so while one is queued for an emitter, more of the same from that
+# emitter are dropped.
+class Dispatcher(object):
+  collapsible = frozenset(['summary-changed', 'progress-changed',
+      'favicon-changed'])
+
+  def __init__(self, clock=reactor):
+    self.clock = clock
+    self.queue = []
+    self.queued = set() # (emitter, name) of collapsible events queued
+    self.call = None
+    self.emitted = 0
+    self.collapsed = 0
+    self.delivered = 0
+    self.drains = 0
+
+  # Handlers are called with (name, *args), or (emitter, name, *args) if
+  # pass_emitter is set.
+  def emit(self, emitter, name, handlers, args, kw, pass_emitter=False):
+    self.emitted += 1
+    if not handlers: return
+
+    if name in self.collapsible and not args and not kw:
+      key = emitter, name
+      if key in self.queued:
+        self.collapsed += 1
+        return
+      self.queued.add(key)
+
+    if pass_emitter:
+      args = (emitter, name) + args
+    else:
+      args = (name,) + args
+    self.queue.append((handlers, args, kw))
+    if self.call is None:
+      self.call = self.clock.callLater(0, self.drain)
+
+  # Events emitted by handlers go in the next drain.
+  def drain(self):
+    self.call = None
+    self.drains += 1
+    queue, self.queue = self.queue, []
+    self.queued.clear()
+    for handlers, args, kw in queue:
+      for handler in handlers:
+        self.delivered += 1
+        try:
+          handler(*args, **kw)
+        except Exception:
+          log.err()
+
+  def stats(self):
+    return dict(emitted=self.emitted, collapsed=self.collapsed,
+        delivered=self.delivered, drains=self.drains,
+        queued=len(self.queue))
+
+dispatcher = Dispatcher()
+
 class EventEmitter(Deferred):
   # The special event name "*" will register a listener for all events.
   def addListener(self, name, listener):
     assert callable(listener)
     self.init_listeners()
     self.listeners[name].append(listener)
+    self.listener_cache.clear()
     return self
 
   def chainEvents(self, other):
@@ -82,8 +147,14 @@ class EventEmitter(Deferred):
 
   def emit(self, name, *args, **kw):
     self.init_listeners()
-    for listener in self.listeners[name] + self.listeners['*']:
-      reactor.callLater(0, listener, name, *args, **kw)
+    try:
+      listeners = self.listener_cache[name]
+    except KeyError:
+      listeners = self.listeners[name] + self.listeners['*']
+      self.listener_cache[name] = listeners
+    dispatcher.emit(self, name, listeners, args, kw)
 
   def init_listeners(self):
-    self.listeners = getattr(self, 'listeners', defaultdict(list))
+    if not hasattr(self, 'listeners'):
+      self.listeners = defaultdict(list)
+      self.listener_cache = {}